@@ -0,0 +1,66 @@
+"""Асинхронный доступ к базе для хендлеров aiogram.
+
+Синхронные запросы SQLAlchemy выполняются в отдельном пуле потоков,
+поэтому медленная запись в SQLite не блокирует event loop и другие чаты.
+Записи идут через run_write — в общий поток-писатель с групповым commit.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from config import DB_EXECUTOR_WORKERS
+from user_cache import cache as user_cache
+from writer import writer
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет func(session, *args, **kwargs) в пуле потоков БД в рамках session_scope"""
+    def call():
+        with database.session_scope() as session:
+            return func(session, *args, **kwargs)
+
+    # Контекст (текущий апдейт для инструментирования и трассировки) переносится в поток
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, context.run, call)
+
+
+async def run_write(func, *args, **kwargs):
+    """Выполняет запись func(session, *args, **kwargs) в потоке-писателе (см. writer.py)"""
+    return await writer.run(func, *args, **kwargs)
+
+
+async def get_user_by_telegram_id(telegram_id):
+    """CachedUser или None; повторные вызовы обслуживаются из кэша"""
+    user = user_cache.get(telegram_id)
+    if user is None:
+        user = await run_db(database.get_user_by_telegram_id, telegram_id)
+        if user is not None:
+            user = user_cache.put(user)
+    return user
+
+
+async def get_or_create_user(telegram_id, username=None, first_name=None, last_name=None, referral_code=None):
+    """CachedUser; для уже известного пользователя запроса к базе нет"""
+    user = user_cache.get(telegram_id)
+    if user is None:
+        user = user_cache.put(await run_write(database.get_or_create_user, telegram_id, username, first_name,
+                                              last_name, referral_code=referral_code))
+    return user
+
+
+async def submit_order(telegram_id, username, first_name, last_name, bot_type, functionality, target_audience,
+                       preferences, budget=100000):
+    return await run_write(database.submit_order, telegram_id, username, first_name, last_name, bot_type,
+                           functionality, target_audience, preferences, budget=budget)
+
+
+async def get_user_orders_page(user_id, page, per_page):
+    return await run_db(database.get_user_orders_page, user_id, page, per_page)
+
+
+async def get_partner_stats(partner_id):
+    return await run_db(database.get_partner_stats, partner_id)
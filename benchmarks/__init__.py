@@ -0,0 +1 @@
+"""Нагрузочные бенчмарки бота и админки (запуск: python -m benchmarks.<модуль> --help)"""
@@ -0,0 +1,237 @@
+"""Сквозной бенчмарк обработки апдейтов.
+
+Строит реалистичный поток апдейтов для тысяч пользователей (/start с
+реферальным кодом, полная анкета OrderForm, партнёрская программа, мои заказы
+и листание страниц), прогоняет его через register_handlers, Dispatcher и
+UpdateQueue, как в проде, но с фейковой сессией Bot API. Показывает
+пропускную способность, p50/p95/p99 времени хендлеров и число SQL-запросов.
+
+    python -m benchmarks.bench_dispatcher --users 2000 --workers 8
+    python -m benchmarks.bench_dispatcher --users 500 --json --min-throughput 300
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from benchmarks.common import prepare_env, QueryCounter, summarize
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='число симулируемых пользователей')
+    parser.add_argument('--orders-per-user', type=int, default=1, help='анкет OrderForm на пользователя')
+    parser.add_argument('--workers', type=int, default=8, help='воркеров UpdateQueue')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка фейкового Bot API, мс')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='файл базы (по умолчанию временный)')
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    parser.add_argument('--min-throughput', type=float, help='код возврата 1, если апдейтов/с меньше')
+    return parser.parse_args(argv)
+
+
+def make_fake_session(api_latency):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import GetMe, SendMessage, EditMessageText
+    from aiogram.types import Message, Chat, User
+
+    class FakeSession(BaseSession):
+        """Отвечает на методы Bot API без сети"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = defaultdict(int)
+            self._message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            if api_latency:
+                await asyncio.sleep(api_latency)
+            if isinstance(method, GetMe):
+                return User(id=42, is_bot=True, first_name='Bench', username='bench_bot')
+            if isinstance(method, (SendMessage, EditMessageText)):
+                return Message(message_id=next(self._message_ids), date=datetime.now(),
+                               chat=Chat(id=method.chat_id or 0, type='private'), text=method.text)
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b''
+
+    return FakeSession()
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, uid):
+        from aiogram.types import User
+        return User(id=uid, is_bot=False, first_name=f'User{uid}', username=f'user{uid}')
+
+    def message(self, uid, text):
+        from aiogram.types import Update, Message, Chat
+        return Update(update_id=next(self._ids), message=Message(
+            message_id=next(self._ids), date=datetime.now(), chat=Chat(id=uid, type='private'),
+            from_user=self._user(uid), text=text))
+
+    def callback(self, uid, data):
+        from aiogram.types import Update, Message, Chat, CallbackQuery
+        return Update(update_id=next(self._ids), callback_query=CallbackQuery(
+            id=str(next(self._ids)), chat_instance=str(uid), from_user=self._user(uid), data=data,
+            message=Message(message_id=1, date=datetime.now(), chat=Chat(id=uid, type='private'), text='-')))
+
+
+def build_scenarios(users, orders_per_user, rng):
+    """Список сценариев (по одному на пользователя) — последовательности апдейтов"""
+    factory = UpdateFactory()
+    scenarios = []
+    for n in range(users):
+        uid = 10_000_000 + n
+        # Примерно треть приходит по реферальной ссылке одного из первых пользователей
+        start = '/start'
+        if n > 10 and rng.random() < 0.3:
+            start = f'/start {rng.randint(1, min(n, 50))}'
+        updates = [factory.message(uid, start)]
+        for _ in range(orders_per_user):
+            updates += [
+                factory.message(uid, '🛒 Оставить заказ'),
+                factory.callback(uid, rng.choice(['type_info', 'type_game', 'type_shop', 'type_support'])),
+                factory.message(uid, 'Приём заказов и уведомления ' * rng.randint(1, 5)),
+                factory.message(uid, 'Предприниматели'),
+                factory.message(uid, str(rng.randint(10, 500) * 1000)),
+                factory.message(uid, 'Без пожеланий'),
+            ]
+        updates += [
+            factory.message(uid, '📊 Партнёрская программа'),
+            factory.message(uid, '📋 Мои заказы'),
+            factory.callback(uid, 'orders_page:0'),
+        ]
+        scenarios.append(updates)
+    return scenarios
+
+
+def interleave(scenarios, rng):
+    """Перемешивает сценарии, сохраняя порядок апдейтов внутри каждого"""
+    cursors = [0] * len(scenarios)
+    active = list(range(len(scenarios)))
+    stream = []
+    while active:
+        i = rng.randrange(len(active))
+        index = active[i]
+        stream.append(scenarios[index][cursors[index]])
+        cursors[index] += 1
+        if cursors[index] == len(scenarios[index]):
+            active[i] = active[-1]
+            active.pop()
+    return stream
+
+
+async def run(args):
+    from aiogram import Bot, Dispatcher
+    from aiogram.dispatcher.middlewares.base import BaseMiddleware
+
+    import database
+    from bot_handlers import register_handlers
+    from fsm_storage import SQLiteStorage, setup_fsm_writes
+    from outbound import scheduler
+    from update_queue import UpdateQueue
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    class TimingMiddleware(BaseMiddleware):
+        async def __call__(self, handler, event, data):
+            name = data['handler'].callback.__name__
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                latencies[name].append(time.perf_counter() - started)
+
+    session = make_fake_session(args.api_latency / 1000)
+    bot = Bot(token='42:BENCHMARK', session=session)
+    storage = SQLiteStorage()
+    dp = Dispatcher(storage=storage)
+    register_handlers(dp)
+    setup_fsm_writes(dp)
+    dp.message.middleware(TimingMiddleware())
+    dp.callback_query.middleware(TimingMiddleware())
+
+    rng = random.Random(args.seed)
+    stream = interleave(build_scenarios(args.users, args.orders_per_user, rng), rng)
+
+    counter = QueryCounter(database.get_engine())
+    queue = UpdateQueue(dp, bot, workers=args.workers, maxsize=len(stream))
+    scheduler.start(bot)
+    counter.reset()
+
+    started = time.perf_counter()
+    queue.start()
+    for update in stream:
+        queue.submit(update)
+    await queue.stop(drain=True, timeout=3600)
+    elapsed = time.perf_counter() - started
+
+    queries = counter.reset()
+    await storage.close()
+    await scheduler.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'users': args.users,
+        'updates': len(stream),
+        'workers': args.workers,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_ups': round(len(stream) / elapsed, 1),
+        'failed_updates': queue.failed,
+        'db_queries': queries,
+        'db_queries_per_update': round(queries / len(stream), 2),
+        'api_calls': dict(session.calls),
+        'handlers': {'*': summarize(all_latencies),
+                     **{name: dict(summarize(values), errors=errors[name])
+                        for name, values in sorted(latencies.items())}},
+    }
+
+
+def print_report(result):
+    print(f"Апдейтов: {result['updates']} от {result['users']} пользователей, воркеров: {result['workers']}")
+    print(f"Время: {result['elapsed_s']} с, пропускная способность: {result['throughput_ups']} апдейтов/с")
+    print(f"SQL-запросов: {result['db_queries']} ({result['db_queries_per_update']} на апдейт), "
+          f"ошибок: {result['failed_updates']}")
+    print(f"Вызовы Bot API: {result['api_calls']}")
+    print()
+    print(f"{'хендлер':<26}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in result['handlers'].items():
+        print(f"{name:<26}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prepare_env(args.db)
+    result = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+    if args.min_throughput and result['throughput_ups'] < args.min_throughput:
+        print(f"Пропускная способность ниже {args.min_throughput} апдейтов/с", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Бенчмарк маршрутов админки на больших объёмах данных.
+
+База растёт ступенями (--sizes — число заказов, пользователей в 10 раз
+меньше); на каждой ступени все маршруты webapp.py вызываются через Flask
+test client. Для каждого маршрута — p50/p95 времени ответа, число SQL-запросов
+и пиковая память Python (tracemalloc) на запрос.
+
+    python -m benchmarks.bench_webapp --sizes 10000,100000
+    python -m benchmarks.bench_webapp --sizes 10000,100000,1000000 --repeat 5 --json
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from benchmarks.common import prepare_env, QueryCounter, summarize
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000', help='объёмы заказов через запятую, по возрастанию')
+    parser.add_argument('--repeat', type=int, default=20, help='запросов на маршрут')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='файл базы (по умолчанию временный)')
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    return parser.parse_args(argv)
+
+
+def build_routes(session, rng):
+    """Маршруты и генераторы запросов к ним: name -> callable(client) -> response"""
+    import re
+    from database import Order, PartnerStats
+
+    partner_ids = [row.partner_id for row in session.query(PartnerStats.partner_id)
+                   .order_by(PartnerStats.total_orders.desc()).limit(20)]
+    max_order_id = session.query(Order.id).order_by(Order.id.desc()).limit(1).scalar() or 1
+
+    def deep_page(client):
+        # Пятая страница: проверяет, что стоимость страницы не растёт с глубиной
+        response = client.get('/orders')
+        for _ in range(4):
+            match = re.search(r'after=([^"&]+)', response.get_data(as_text=True))
+            if not match:
+                break
+            response = client.get(f'/orders?after={match.group(1)}')
+        return response
+
+    return {
+        'GET /': lambda client: client.get('/'),
+        'GET /orders': lambda client: client.get('/orders'),
+        'GET /orders?status=new': lambda client: client.get('/orders?status=new'),
+        'GET /orders?partner=…': lambda client: client.get(f'/orders?partner={rng.choice(partner_ids or [1])}'),
+        'GET /orders (5 страниц)': deep_page,
+        'POST update_order_status': lambda client: client.post(
+            f'/api/update_order_status/{rng.randint(1, max_order_id)}',
+            json={'status': rng.choice(['new', 'in_progress', 'completed'])}),
+        'DELETE delete_order': lambda client: client.delete(f'/api/delete_order/{rng.randint(1, max_order_id)}'),
+    }
+
+
+def bench_routes(client, routes, counter, repeat):
+    results = {}
+    for name, request in routes.items():
+        latencies, queries, peaks, statuses = [], [], [], set()
+        for _ in range(repeat):
+            counter.reset()
+            tracemalloc.start()
+            started = time.perf_counter()
+            response = request(client)
+            latencies.append(time.perf_counter() - started)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            queries.append(counter.reset())
+            statuses.add(response.status_code)
+        results[name] = dict(summarize(latencies),
+                             queries=round(sum(queries) / len(queries), 1),
+                             peak_kib=round(max(peaks) / 1024, 1),
+                             statuses=sorted(statuses))
+    return results
+
+
+def print_report(report):
+    for step in report:
+        print(f"\nЗаказов: {step['orders']}, пользователей: {step['users']}")
+        print(f"{'маршрут':<28}{'p50, мс':>10}{'p95, мс':>10}{'запросов':>10}{'пик, КиБ':>11}  статусы")
+        for name, stats in step['routes'].items():
+            print(f"{name:<28}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['queries']:>10}"
+                  f"{stats['peak_kib']:>11}  {stats['statuses']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prepare_env(args.db)
+
+    from database import init_db, session_scope
+    from benchmarks.seed import seed
+    import webapp
+
+    engine = init_db()
+    counter = QueryCounter(engine)
+    client = webapp.app.test_client()
+    rng = random.Random(args.seed)
+
+    report = []
+    seeded = 0
+    for size in sorted(int(value) for value in args.sizes.split(',')):
+        seed(engine, users=(size - seeded) // 10, orders=size - seeded, seed_value=args.seed + size,
+             log=lambda line: print(line, file=sys.stderr))
+        seeded = size
+        with session_scope() as session:
+            routes = build_routes(session, rng)
+        report.append({'orders': size, 'users': size // 10,
+                       'routes': bench_routes(client, routes, counter, args.repeat)})
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
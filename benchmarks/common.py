@@ -0,0 +1,61 @@
+"""Общее для бенчмарков: окружение, подсчёт SQL-запросов, перцентили."""
+import os
+import tempfile
+import threading
+
+
+def prepare_env(db_path=None, fast_outbound=True):
+    """Настраивает окружение до импорта модулей бота (config читает его при импорте).
+
+    Без db_path база создаётся во временном каталоге, чтобы не трогать bot_orders.db.
+    """
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='bench_'), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('BOT_TOKEN', '42:BENCHMARK')
+    os.environ.setdefault('ADMIN_IDS', '1,2')
+    if fast_outbound:
+        # Лимиты Telegram замерялись бы вместо бота
+        os.environ.setdefault('OUTBOUND_GLOBAL_RATE', '1000000')
+        os.environ.setdefault('OUTBOUND_CHAT_RATE', '1000000')
+        os.environ.setdefault('OUTBOUND_CHAT_BURST', '1000000')
+    return db_path
+
+
+class QueryCounter:
+    """Считает SQL-запросы к движку (потокобезопасно)"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """p50/p95/p99/max в миллисекундах"""
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
@@ -0,0 +1,110 @@
+"""Генератор синтетических данных для bot_orders.db.
+
+Создаёт пользователей с реферальными цепочками (партнёр привёл клиента,
+тот — следующего и т.д.) и заказы с реалистичным распределением статусов.
+Вставка идёт пакетами через Core, поэтому 1M заказов занимают минуты;
+partner_stats пересчитывается в конце.
+
+    python -m benchmarks.seed --users 10000 --orders 100000 --db /tmp/big.db
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import prepare_env
+
+BATCH_SIZE = 10000
+STATUSES = ['new', 'in_progress', 'completed', 'archived']
+STATUS_WEIGHTS = [0.3, 0.2, 0.4, 0.1]
+BOT_TYPES = ['Информационный', 'Игровой', 'Магазин', 'Поддержка', 'Автоворонка']
+WORDS = ('бот заказы оплата уведомления каталог корзина доставка запись расписание рассылка '
+         'опрос игра рейтинг поддержка тикеты crm интеграция таблицы аналитика отчёты').split()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(engine, users, orders, partner_share=0.05, chain_share=0.3, days=365, seed_value=1, log=print):
+    """Добавляет users пользователей и orders заказов к уже существующим данным"""
+    from sqlalchemy import func, select
+    from database import User, Order, rebuild_partner_stats
+
+    rng = random.Random(seed_value)
+    users_table, orders_table = User.__table__, Order.__table__
+    now = datetime.now()
+
+    with engine.begin() as connection:
+        first_user_id = (connection.execute(select(func.max(users_table.c.id))).scalar() or 0) + 1
+        next_telegram_id = (connection.execute(select(func.max(users_table.c.telegram_id))).scalar() or 0) + 1
+
+    started = time.perf_counter()
+    user_ids = list(range(first_user_id, first_user_id + users))
+    referrals = {}
+    partners = set()
+    rows = []
+    for n, user_id in enumerate(user_ids):
+        referral_id = None
+        if n and rng.random() < chain_share:
+            # Чаще всего реферер — один из недавних пользователей: получаются цепочки
+            referral_id = user_ids[max(0, n - rng.randint(1, 20))]
+        elif n and rng.random() < partner_share:
+            referral_id = rng.choice(user_ids[:n])
+        if referral_id:
+            referrals[user_id] = referral_id
+            partners.add(referral_id)
+        rows.append({
+            'id': user_id, 'telegram_id': next_telegram_id + n, 'username': f'user{next_telegram_id + n}',
+            'first_name': f'Имя{n}', 'last_name': None, 'referral_id': referral_id,
+            'join_date': now - timedelta(days=rng.uniform(0, days)), 'is_partner': False,
+        })
+    for row in rows:
+        row['is_partner'] = row['id'] in partners or row['referral_id'] is not None
+
+    with engine.begin() as connection:
+        for i in range(0, len(rows), BATCH_SIZE):
+            connection.execute(users_table.insert(), rows[i:i + BATCH_SIZE])
+    log(f"Пользователей: +{users} за {time.perf_counter() - started:.1f} с")
+
+    started = time.perf_counter()
+    all_user_ids = user_ids or [1]
+    with engine.begin() as connection:
+        for i in range(0, orders, BATCH_SIZE):
+            batch = []
+            for _ in range(min(BATCH_SIZE, orders - i)):
+                user_id = rng.choice(all_user_ids)
+                partner_id = referrals.get(user_id) if rng.random() < 0.5 else None
+                status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+                batch.append({
+                    'user_id': user_id, 'partner_id': partner_id, 'bot_type': rng.choice(BOT_TYPES),
+                    'functionality': _text(rng, 30), 'target_audience': _text(rng, 10),
+                    'preferences': _text(rng, 10), 'status': status,
+                    'created_at': now - timedelta(seconds=rng.uniform(0, days * 86400)),
+                    'partner_paid': status == 'completed' and rng.random() < 0.5,
+                    'partner_percent': rng.choice([10.0, 20.0]) if partner_id else 0.0,
+                    'amount': float(rng.randint(10, 500) * 1000),
+                })
+            connection.execute(orders_table.insert(), batch)
+        rebuild_partner_stats(connection)
+    log(f"Заказов: +{orders} за {time.perf_counter() - started:.1f} с")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', required=True, help='файл базы (будет создан или дополнен)')
+    args = parser.parse_args(argv)
+
+    prepare_env(args.db)
+    from database import init_db
+
+    seed(init_db(), args.users, args.orders, seed_value=args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
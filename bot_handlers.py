@@ -2,18 +2,24 @@ from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton
 )
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from collections import OrderedDict
 from datetime import datetime
+import threading
+import time
 
-from database import init_db, User, Order, get_session, get_or_create_user, create_order, get_user_orders
+from database import init_db, add_commit_listener, Order
+from outbound import answer, send_message
+from async_db import get_user_by_telegram_id, get_or_create_user, submit_order, get_user_orders_page, \
+    get_partner_stats
 from config import ADMIN_IDS, ADMIN_USERNAME, CURRENCY, REFERRAL_PERCENT, REFERRAL_PERCENT_PREMIUM, \
-    MIN_REFERRALS_FOR_PREMIUM
+    MIN_REFERRALS_FOR_PREMIUM, BOT_ORDERS_PAGE_SIZE
 
 # Инициализация базы данных
 engine = init_db()
@@ -65,30 +71,16 @@ async def cmd_start(message: Message, state: FSMContext):
     args = message.text.split()
     referral_code = args[1] if len(args) > 1 else None
 
-    session = get_session()
-    user = session.query(User).filter_by(telegram_id=message.from_user.id).first()
-
-    if not user:
-        user = User(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
-
-        if referral_code and referral_code.isdigit():
-            referrer = session.query(User).filter_by(id=int(referral_code)).first()
-            if referrer:
-                user.referral_id = referrer.id
-                referrer.is_partner = True
-                user.is_partner = True
-
-        session.add(user)
-        session.commit()
-
-    session.close()
+    await get_or_create_user(
+        message.from_user.id,
+        message.from_user.username,
+        message.from_user.first_name,
+        message.from_user.last_name,
+        referral_code=referral_code
+    )
 
-    await message.answer(
+    await answer(
+        message,
         f"👋 Привет, {message.from_user.first_name}!\n\n"
         "🤖 Я бот для заказа Telegram-ботов под ключ.\n\n"
         "✨ Что я могу:\n"
@@ -101,7 +93,8 @@ async def cmd_start(message: Message, state: FSMContext):
 
 
 async def cmd_help(message: Message):
-    await message.answer(
+    await answer(
+        message,
         f"🆘 Помощь по боту:\n\n"
         f"🛒 Как сделать заказ:\n"
         f"1. Нажмите 'Оставить заказ'\n"
@@ -116,20 +109,14 @@ async def cmd_help(message: Message):
 
 
 async def show_partner_program(message: Message):
-    session = get_session()
-    user = session.query(User).filter_by(telegram_id=message.from_user.id).first()
+    user = await get_user_by_telegram_id(message.from_user.id)
 
     if not user:
-        session.close()
-        await message.answer("Сначала нажмите /start")
+        await answer(message, "Сначала нажмите /start")
         return
 
     # Статистика
-    referrals_count = session.query(User).filter_by(referral_id=user.id).count()
-    partner_orders = session.query(Order).filter_by(partner_id=user.id).all()
-    completed_orders = [o for o in partner_orders if o.status == 'completed']
-    pending_payments = sum(o.amount * o.partner_percent / 100 for o in completed_orders if not o.partner_paid)
-    total_earnings = sum(o.amount * o.partner_percent / 100 for o in completed_orders if o.partner_paid)
+    stats = await get_partner_stats(user.id)
 
     bot = await message.bot.get_me()
     referral_link = f"https://t.me/{bot.username}?start={user.id}"
@@ -146,66 +133,161 @@ async def show_partner_program(message: Message):
 • Выплаты в течение 3 дней после выполнения заказа
 
 📈 Ваша статистика:
-• Приведено клиентов: {referrals_count}
-• Выполненных заказов: {len(completed_orders)}
-• Ожидает выплаты: {pending_payments:.0f}{CURRENCY}
-• Всего заработано: {total_earnings:.0f}{CURRENCY}
+• Приведено клиентов: {stats['total_referrals']}
+• Выполненных заказов: {stats['completed_orders']}
+• Ожидает выплаты: {stats['pending_payments']:.0f}{CURRENCY}
+• Всего заработано: {stats['total_earnings']:.0f}{CURRENCY}
 
 Чтобы стать партнёром, просто поделитесь своей ссылкой!"""
 
-    session.close()
-
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(
         text="📋 Копировать реферальную ссылку",
         callback_data=f"copy_ref_{user.id}"
     ))
-    await message.answer(partner_text, reply_markup=builder.as_markup())
+    await answer(message, partner_text, reply_markup=builder.as_markup())
+
+
+# ====== Мои заказы ======
+# Одно сообщение с постраничным просмотром. Отрисованные страницы кэшируются
+# по пользователю и сбрасываются, когда меняется любой его заказ. Как в
+# DashboardCache, страница, чтение которой началось до сброса, в кэш не
+# попадает, а TTL ограничивает устаревание, если событие всё же потерялось.
+
+ORDER_STATUS_INFO = {
+    'new': ('🆕', 'Новый'),
+    'in_progress': ('⏳', 'В работе'),
+    'completed': ('✅', 'Выполнен'),
+    'paid': ('💰', 'Оплачен')
+}
+ORDER_PAGES_CACHE_SIZE = 10000
+ORDER_PAGES_CACHE_TTL = 300  # секунд
+
+_order_pages = OrderedDict()  # user_id -> {page: (expires_at, (text, total_pages))}
+_order_pages_reset = OrderedDict()  # user_id -> время последнего сброса, не старше TTL
+_order_pages_lock = threading.Lock()
+
+
+@add_commit_listener
+def _invalidate_order_pages(changes):
+    user_ids = {obj.user_id for obj, op in changes if isinstance(obj, Order)}
+    if user_ids:
+        now = time.monotonic()
+        with _order_pages_lock:
+            for user_id in user_ids:
+                _order_pages.pop(user_id, None)
+                _order_pages_reset[user_id] = now
+                _order_pages_reset.move_to_end(user_id)
+            # Чтение дольше TTL не защищено, но и его страница проживёт не дольше TTL
+            while next(iter(_order_pages_reset.values())) < now - ORDER_PAGES_CACHE_TTL:
+                _order_pages_reset.popitem(last=False)
+
+
+def render_order(order):
+    emoji, status_text = ORDER_STATUS_INFO.get(order.status, ('📄', order.status))
+    functionality = order.functionality or ''
+    target_audience = order.target_audience or ''
+    return f"""📋 Заказ #{order.id}
+━━━━━━━━━━━━━━
+📅 Дата: {order.created_at.strftime('%d.%m.%Y %H:%M')}
+📊 Тип бота: {order.bot_type}
+⚡ Статус: {emoji} {status_text}
+💰 Сумма: {order.amount:.0f}{CURRENCY}
+━━━━━━━━━━━━━━
+🎯 Функционал:
+{functionality[:200]}{'...' if len(functionality) > 200 else ''}
+
+👥 Целевая аудитория:
+{target_audience[:200]}{'...' if len(target_audience) > 200 else ''}"""
+
+
+async def get_orders_page(user_id, page):
+    """Возвращает (text, total_pages) для страницы page, из кэша или из базы"""
+    with _order_pages_lock:
+        cached = _order_pages.get(user_id, {}).get(page)
+        if cached and cached[0] > time.monotonic():
+            _order_pages.move_to_end(user_id)
+            return cached[1]
+    started = time.monotonic()
+
+    orders, total = await get_user_orders_page(user_id, page, BOT_ORDERS_PAGE_SIZE)
+    if not total:
+        return None, 0
+
+    total_pages = (total + BOT_ORDERS_PAGE_SIZE - 1) // BOT_ORDERS_PAGE_SIZE
+    if not orders:
+        # Страница исчезла (заказы удалили) — покажем последнюю
+        return await get_orders_page(user_id, total_pages - 1)
+
+    text = f"📋 Ваши заказы ({total})\n\n" + "\n\n".join(render_order(order) for order in orders)
+    result = (text, total_pages)
+    with _order_pages_lock:
+        # Заказы пользователя изменились, пока мы читали, — страница уже устарела
+        if _order_pages_reset.get(user_id, float('-inf')) < started:
+            _order_pages.setdefault(user_id, {})[page] = (started + ORDER_PAGES_CACHE_TTL, result)
+            _order_pages.move_to_end(user_id)
+            while len(_order_pages) > ORDER_PAGES_CACHE_SIZE:
+                _order_pages.popitem(last=False)
+    return result
+
+
+def get_orders_pager_keyboard(page, total_pages):
+    if total_pages <= 1:
+        return None
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="◀️", callback_data=f"orders_page:{page - 1}")
+    builder.button(text=f"{page + 1}/{total_pages}", callback_data="orders_page:noop")
+    if page < total_pages - 1:
+        builder.button(text="▶️", callback_data=f"orders_page:{page + 1}")
+    return builder.as_markup()
 
 
 async def show_my_orders(message: Message):
-    session = get_session()
-    user = session.query(User).filter_by(telegram_id=message.from_user.id).first()
+    user = await get_user_by_telegram_id(message.from_user.id)
 
     if not user:
-        session.close()
-        await message.answer("Сначала нажмите /start")
+        await answer(message, "Сначала нажмите /start")
         return
 
-    orders = session.query(Order).filter_by(user_id=user.id).order_by(Order.created_at.desc()).all()
-    session.close()
+    text, total_pages = await get_orders_page(user.id, 0)
 
-    if not orders:
-        await message.answer("📭 У вас пока нет заказов.")
+    if not text:
+        await answer(message, "📭 У вас пока нет заказов.")
         return
 
-    for order in orders:
-        status_info = {
-            'new': ('🆕', 'Новый'),
-            'in_progress': ('⏳', 'В работе'),
-            'completed': ('✅', 'Выполнен'),
-            'paid': ('💰', 'Оплачен')
-        }
-        emoji, status_text = status_info.get(order.status, ('📄', order.status))
+    await answer(message, text, reply_markup=get_orders_pager_keyboard(0, total_pages))
 
-        order_text = f"""📋 Заказ #{order.id}
-━━━━━━━━━━━━━━
-📅 Дата: {order.created_at.strftime('%d.%m.%Y %H:%M')}
-📊 Тип бота: {order.bot_type}
-⚡ Статус: {emoji} {status_text}
-💰 Сумма: {order.amount:.0f}{CURRENCY}
-━━━━━━━━━━━━━━
-🎯 Функционал:
-{order.functionality[:200]}{'...' if len(order.functionality) > 200 else ''}
 
-👥 Целевая аудитория:
-{order.target_audience[:200]}{'...' if len(order.target_audience) > 200 else ''}"""
+async def flip_orders_page(callback: CallbackQuery):
+    value = callback.data.split(':', 1)[1]
+    if not value.isdigit():
+        await callback.answer()
+        return
 
-        await message.answer(order_text)
+    user = await get_user_by_telegram_id(callback.from_user.id)
+    if not user:
+        await callback.answer("Сначала нажмите /start", show_alert=True)
+        return
+
+    page = int(value)
+    text, total_pages = await get_orders_page(user.id, page)
+    if not text:
+        await callback.message.edit_text("📭 У вас пока нет заказов.")
+    else:
+        page = min(page, total_pages - 1)
+        try:
+            await callback.message.edit_text(text, reply_markup=get_orders_pager_keyboard(page, total_pages))
+        except TelegramBadRequest as e:
+            # Повторное нажатие на ту же страницу
+            if 'message is not modified' not in str(e):
+                raise
+    await callback.answer()
 
 
 async def start_order(message: Message, state: FSMContext):
-    await message.answer(
+    await answer(
+        message,
         "🎯 Вы начали оформление заказа на создание бота!\n\n"
         "📝 Сначала выберите тип бота:",
         reply_markup=get_bot_type_keyboard()
@@ -216,7 +298,7 @@ async def start_order(message: Message, state: FSMContext):
 async def process_bot_type(callback: CallbackQuery, state: FSMContext):
     if callback.data == "cancel":
         await state.clear()
-        await callback.message.answer("❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
+        await answer(callback.message, "❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
         return
 
     bot_types = {
@@ -231,7 +313,8 @@ async def process_bot_type(callback: CallbackQuery, state: FSMContext):
     if bot_type:
         await state.update_data(bot_type=bot_type)
         await callback.message.edit_text(f"✅ Выбран тип: {bot_type}")
-        await callback.message.answer(
+        await answer(
+            callback.message,
             "📝 Теперь опишите основной функционал бота:\n"
             "(например: прием заказов, отправка уведомлений, игра и т.д.)",
             reply_markup=get_cancel_keyboard()
@@ -242,11 +325,12 @@ async def process_bot_type(callback: CallbackQuery, state: FSMContext):
 async def process_functionality(message: Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
-        await message.answer("❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
+        await answer(message, "❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
         return
 
     await state.update_data(functionality=message.text)
-    await message.answer(
+    await answer(
+        message,
         "✅ Функционал сохранен!\n\n"
         "👥 Опишите целевую аудиторию вашего бота:\n"
         "(например: предприниматели, геймеры, студенты и т.д.)",
@@ -258,11 +342,12 @@ async def process_functionality(message: Message, state: FSMContext):
 async def process_target_audience(message: Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
-        await message.answer("❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
+        await answer(message, "❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
         return
 
     await state.update_data(target_audience=message.text)
-    await message.answer(
+    await answer(
+        message,
         "✅ Целевая аудитория сохранена!\n\n"
         f"💰 Теперь укажите ваш бюджет на создание бота (в {CURRENCY}):\n"
         "(например: 50000, 100000, 150000 и т.д.)",
@@ -274,23 +359,24 @@ async def process_target_audience(message: Message, state: FSMContext):
 async def process_budget(message: Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
-        await message.answer("❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
+        await answer(message, "❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
         return
 
     try:
         budget = float(message.text.replace(',', '.'))
         if budget < 10000:
-            await message.answer(f"❌ Минимальный бюджет 10000{CURRENCY}. Введите снова:")
+            await answer(message, f"❌ Минимальный бюджет 10000{CURRENCY}. Введите снова:")
             return
         if budget > 10000000:
-            await message.answer(f"❌ Слишком большая сумма. Введите сумму до 10,000,000{CURRENCY}:")
+            await answer(message, f"❌ Слишком большая сумма. Введите сумму до 10,000,000{CURRENCY}:")
             return
     except ValueError:
-        await message.answer("❌ Пожалуйста, введите число (например: 50000)")
+        await answer(message, "❌ Пожалуйста, введите число (например: 50000)")
         return
 
     await state.update_data(budget=budget)
-    await message.answer(
+    await answer(
+        message,
         f"✅ Бюджет {budget:.0f}{CURRENCY} сохранен!\n\n"
         "✨ Теперь укажите дополнительные пожелания:\n"
         "(например: дизайн, интеграции, сроки и т.д.)",
@@ -302,35 +388,18 @@ async def process_budget(message: Message, state: FSMContext):
 async def process_preferences(message: Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
-        await message.answer("❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
+        await answer(message, "❌ Создание заказа отменено.", reply_markup=get_main_keyboard())
         return
 
     await state.update_data(preferences=message.text)
     data = await state.get_data()
 
-    # Сохраняем заказ в базу данных
-    session = get_session()
-    
-    # СОЗДАЕМ ПОЛЬЗОВАТЕЛЯ
-    user = get_or_create_user(
-        session,
+    # Пользователь, партнёр и процент определяются и заказ сохраняется одной транзакцией
+    order, user, partner = await submit_order(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name,
-        message.from_user.last_name
-    )
-    
-    # ПРОВЕРЯЕМ что пользователь создан
-    if user is None:
-        await message.answer("❌ Ошибка: не удалось создать пользователя. Попробуйте /start")
-        session.close()
-        await state.clear()
-        return
-    
-    # Теперь user точно существует!
-    order = create_order(
-        session,
-        user_id=user.id,  # ← Теперь безопасно!
+        message.from_user.last_name,
         bot_type=data['bot_type'],
         functionality=data['functionality'],
         target_audience=data['target_audience'],
@@ -338,24 +407,6 @@ async def process_preferences(message: Message, state: FSMContext):
         budget=data.get('budget', 100000)
     )
 
-    # Проверяем реферала
-    if user.referral_id:
-        order.partner_id = user.referral_id
-        referrals_count = session.query(User).filter_by(referral_id=user.referral_id).count()
-        order.partner_percent = REFERRAL_PERCENT_PREMIUM if referrals_count >= MIN_REFERRALS_FOR_PREMIUM else REFERRAL_PERCENT
-
-        # Создаём запись о выплате
-        payment = PartnerPayment(
-            partner_id=user.referral_id,
-            order_id=order.id,
-            amount=order.amount * order.partner_percent / 100,
-            percent=order.partner_percent
-        )
-        session.add(payment)
-
-    session.add(order)
-    session.commit()
-
     # Уведомление админам
     admin_text = f"""🚨 НОВЫЙ ЗАКАЗ #{order.id}
 ━━━━━━━━━━━━━━━━━
@@ -370,20 +421,17 @@ async def process_preferences(message: Message, state: FSMContext):
 👥 Целевая аудитория:
 {order.target_audience[:500]}{'...' if len(order.target_audience) > 500 else ''}"""
 
-    if order.partner_id:
-        partner = session.query(User).filter_by(id=order.partner_id).first()
-        if partner:
-            admin_text += f"\n\n👥 Партнёр: {partner.first_name} (@{partner.username or 'нет'})"
-            admin_text += f"\n💰 Процент: {order.partner_percent}% ({order.amount * order.partner_percent / 100:.0f}{CURRENCY})"
+    if partner:
+        admin_text += f"\n\n👥 Партнёр: {partner.first_name} (@{partner.username or 'нет'})"
+        admin_text += f"\n💰 Процент: {order.partner_percent}% ({order.amount * order.partner_percent / 100:.0f}{CURRENCY})"
 
+    # Не ждём доставки: планировщик соблюдает лимиты и переотправит при сбое
     for admin_id in ADMIN_IDS:
-        try:
-            await message.bot.send_message(admin_id, admin_text)
-        except Exception as e:
-            print(f"Ошибка отправки админу {admin_id}: {e}")
+        await send_message(message.bot, admin_id, admin_text, wait=False, persist=True)
 
     # Подтверждение пользователю
-    await message.answer(
+    await answer(
+        message,
         f"🎉 Заказ успешно создан!\n\n"
         f"📋 Номер вашего заказа: #{order.id}\n"
         f"💰 Бюджет заказа: {order.amount:.0f}{CURRENCY}\n"
@@ -392,7 +440,6 @@ async def process_preferences(message: Message, state: FSMContext):
         reply_markup=get_main_keyboard()
     )
 
-    session.close()
     await state.clear()
 
 
@@ -405,15 +452,22 @@ async def copy_referral_link(callback: CallbackQuery):
 
 async def cancel_action(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.answer("❌ Действие отменено.", reply_markup=get_main_keyboard())
+    await answer(callback.message, "❌ Действие отменено.", reply_markup=get_main_keyboard())
 
 
 def register_handlers(dp: Dispatcher):
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(cmd_help, F.text == "🆘 Помощь")
     dp.message.register(start_order, F.text == "🛒 Оставить заказ")
-    dp.message.register(show_partner_program, F.text == "📊 Партнёрская программа")
-    dp.message.register(show_my_orders, F.text == "📋 Мои заказы")
+    # Тяжёлые экраны: при частых нажатиях отвечаем последним ответом (см. throttling.py)
+    dp.message.register(show_partner_program, F.text == "📊 Партнёрская программа",
+                        flags={'throttling': {'rate': 0.2, 'burst': 2, 'cache_ttl': 10}})
+    dp.message.register(show_my_orders, F.text == "📋 Мои заказы",
+                        flags={'throttling': {'rate': 0.2, 'burst': 2, 'cache_ttl': 10}})
+
+    # Листание заказов работает в любом состоянии, поэтому регистрируется раньше анкеты
+    dp.callback_query.register(flip_orders_page, F.data.startswith("orders_page:"),
+                               flags={'throttling': {'rate': 1, 'burst': 5, 'window': 0.5}})
 
     dp.callback_query.register(process_bot_type, OrderForm.bot_type)
     dp.message.register(process_functionality, OrderForm.functionality)
@@ -429,7 +483,7 @@ def register_handlers(dp: Dispatcher):
         current_state = await state.get_state()
         if not current_state:
 
-            await message.answer("Используйте кнопки меню:", reply_markup=get_main_keyboard())
+            await answer(message, "Используйте кнопки меню:", reply_markup=get_main_keyboard())
 
 
 
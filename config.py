@@ -41,4 +41,76 @@ else:
 REFERRAL_PERCENT = 10  # Стандартный процент
 REFERRAL_PERCENT_PREMIUM = 20  # Премиум процент (3+ реферала)
 MIN_REFERRALS_FOR_PREMIUM = 3
-CURRENCY = '₸'  # Казахстанский тенге
\ No newline at end of file
+CURRENCY = '₸'  # Казахстанский тенге
+
+# Настройки базы данных
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///bot_orders.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # OFF / NORMAL / FULL
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', DB_POOL_SIZE))  # Потоки для запросов из asyncio
+
+# Очередь входящих апдейтов
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_OVERLOAD_POLICY = os.getenv('UPDATE_OVERLOAD_POLICY', 'reject')  # reject (429) / shed (200 и отброс)
+
+# Long polling (BOT_MODE = "polling")
+POLLING_LIMIT = int(os.getenv('POLLING_LIMIT', 100))  # Апдейтов за один getUpdates (максимум Telegram — 100)
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 25))  # Секунд ожидания на стороне Telegram
+
+# Админка
+ADMIN_WORKERS = int(os.getenv('ADMIN_WORKERS', 4))  # Потоки для запросов админки
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', 50))
+BULK_MAX_ORDERS = int(os.getenv('BULK_MAX_ORDERS', 5000))  # заказов в одной массовой операции
+PARTNER_FILTER_LIMIT = int(os.getenv('PARTNER_FILTER_LIMIT', 200))  # партнёров в фильтре /orders
+
+# Бот
+BOT_ORDERS_PAGE_SIZE = int(os.getenv('BOT_ORDERS_PAGE_SIZE', 5))  # заказов на странице "Мои заказы"
+
+# Исходящие сообщения (лимиты Telegram Bot API)
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', 16))
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))  # сообщений/с на весь бот
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))  # сообщений/с в личный чат
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', 20 / 60))  # сообщений/с в группу
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', 5))  # попыток для сохранённых сообщений
+OUTBOUND_RETRY_INTERVAL = int(os.getenv('OUTBOUND_RETRY_INTERVAL', 30))  # секунд
+
+# FSM (анкета заказа)
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 3600))  # брошенная анкета удаляется через, секунд
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+
+# Инструментирование SQL (можно включать на лету: POST /api/debug/sql)
+SQL_INSTRUMENTATION = os.getenv('SQL_INSTRUMENTATION', '0') == '1'
+SQL_SLOW_QUERY_MS = float(os.getenv('SQL_SLOW_QUERY_MS', 100))
+SQL_REPEAT_THRESHOLD = int(os.getenv('SQL_REPEAT_THRESHOLD', 5))  # одинаковых запросов за единицу работы = N+1
+SQL_SLOW_LOG_FILE = os.getenv('SQL_SLOW_LOG_FILE', '')  # пусто — в общий лог
+
+# Трассировка апдейтов (JSONL, по строке на span)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # доля трассируемых апдейтов, 0 — выключено
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+
+# Дедупликация вебхука по update_id
+WEBHOOK_DEDUP_SIZE = int(os.getenv('WEBHOOK_DEDUP_SIZE', 50000))
+WEBHOOK_DEDUP_TTL = int(os.getenv('WEBHOOK_DEDUP_TTL', 86400))  # Telegram хранит недоставленные апдейты сутки
+WEBHOOK_DEDUP_PERSIST = os.getenv('WEBHOOK_DEDUP_PERSIST', '1') == '1'
+
+# Ограничение частоты апдейтов от одного пользователя (на хендлер, переопределяется флагом throttling)
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 1.0))  # апдейтов/с
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', 5))
+THROTTLE_COALESCE_WINDOW = float(os.getenv('THROTTLE_COALESCE_WINDOW', 1.0))  # с, одинаковые запросы подряд
+
+# Кэш пользователей по telegram_id
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+
+# Групповой commit: все записи в базу идут через один поток-писатель
+WRITE_MAX_LATENCY_MS = float(os.getenv('WRITE_MAX_LATENCY_MS', 2))  # сколько ждать попутчиков в пачку
+WRITE_MAX_BATCH = int(os.getenv('WRITE_MAX_BATCH', 200))
+
+# Кэш дашборда админки
+DASHBOARD_CACHE_TTL = int(os.getenv('DASHBOARD_CACHE_TTL', 60))
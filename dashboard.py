@@ -0,0 +1,154 @@
+"""Кэш агрегатов для главной страницы админки.
+
+Дашборд состоит из независимых разделов (счётчики заказов, число партнёров,
+сумма к выплате, последние заказы). Каждый раздел считается одним запросом,
+кэшируется на DASHBOARD_CACHE_TTL и сбрасывается по событиям записи
+(add_commit_listener). Счётчики заказов и партнёров при вставке и удалении
+не пересчитываются, а правятся на месте, поэтому поток новых заказов из бота
+не заставляет каждый раз заново считать COUNT(*) по всей таблице. Править
+можно только значение, посчитанное до начала commit: более позднее уже
+учитывает изменение, и такой раздел сбрасывается.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import func, case
+
+from database import User, Order, PartnerStats, add_commit_listener, commit_started
+from config import DASHBOARD_CACHE_TTL
+
+RECENT_ORDERS = 5
+
+
+def _count_orders(session):
+    total, new = session.query(func.count(Order.id),
+                               func.coalesce(func.sum(case((Order.status == 'new', 1), else_=0)), 0)).one()
+    return {'total_orders': total, 'new_orders': new}
+
+
+def _count_partners(session):
+    return {'total_partners': session.query(func.count(User.id)).filter(User.is_partner == True).scalar()}
+
+
+def _sum_pending(session):
+    return {'pending_payments': session.query(func.coalesce(func.sum(PartnerStats.pending_commission), 0)).scalar()}
+
+
+def _recent_orders(session):
+    # Импорт здесь: webapp импортирует этот модуль
+    from webapp import query_orders_with_users
+
+    rows = query_orders_with_users(session) \
+        .order_by(Order.created_at.desc(), Order.id.desc()).limit(RECENT_ORDERS).all()
+    orders = []
+    for order, user, partner in rows:
+        orders.append({
+            'id': order.id,
+            'user': {
+                'name': f"{user.first_name} {user.last_name or ''}",
+                'username': user.username
+            } if user else {'name': 'Неизвестно', 'username': ''},
+            'bot_type': order.bot_type,
+            'status': order.status,
+            'amount': order.amount,
+            'created_at': order.created_at,
+            'partner': {
+                'name': f"{partner.first_name} {partner.last_name or ''}",
+                'username': partner.username
+            } if partner else None
+        })
+    return {'orders': orders}
+
+
+SECTIONS = {
+    'orders': _count_orders,
+    'partners': _count_partners,
+    'pending': _sum_pending,
+    'recent': _recent_orders,
+}
+
+
+class DashboardCache:
+    def __init__(self, ttl=DASHBOARD_CACHE_TTL):
+        self.ttl = ttl
+        self._sections = {}  # имя раздела -> (expires, dict значений, когда досчитан)
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session):
+        """Все значения дашборда; пересчитываются только устаревшие разделы"""
+        result = {}
+        for name, compute in SECTIONS.items():
+            with self._lock:
+                item = self._sections.get(name)
+                version = self._versions[name]
+            if item is not None and item[0] > time.monotonic():
+                self.hits += 1
+                result.update(item[1])
+                continue
+            self.misses += 1
+            values = compute(session)
+            with self._lock:
+                # Если раздел изменился, пока мы считали, результат мог это изменение не увидеть
+                if self._versions[name] == version:
+                    now = time.monotonic()
+                    self._sections[name] = (now + self.ttl, values, now)
+            result.update(values)
+        return result
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names or list(SECTIONS):
+                self._discard(name)
+
+    def _discard(self, name):
+        self._versions[name] += 1
+        self._sections.pop(name, None)
+
+    def _adjust(self, name, key, delta):
+        """Правит закэшированный счётчик на месте, если он посчитан до начала commit"""
+        item = self._sections.get(name)
+        started = commit_started()
+        if item is None or started is None or item[2] >= started:
+            # Посчитан между началом commit и этим уведомлением — изменение мог уже увидеть
+            self._discard(name)
+            return
+        self._versions[name] += 1
+        item[1][key] += delta
+
+    def apply_changes(self, changes):
+        with self._lock:
+            for obj, op in changes:
+                if isinstance(obj, Order):
+                    self._discard('recent')
+                    if obj.partner_id:
+                        self._discard('pending')
+                    if op == 'update':
+                        # Прежний статус после commit неизвестен — считаем заново
+                        self._discard('orders')
+                        continue
+                    delta = 1 if op == 'insert' else -1
+                    self._adjust('orders', 'total_orders', delta)
+                    if obj.status == 'new':
+                        self._adjust('orders', 'new_orders', delta)
+                elif isinstance(obj, User):
+                    self._discard('recent')
+                    if op == 'insert':
+                        if obj.is_partner:
+                            self._adjust('partners', 'total_partners', 1)
+                    else:
+                        self._discard('partners')
+
+    def stats(self):
+        return {'sections': len(self._sections), 'hits': self.hits, 'misses': self.misses}
+
+
+cache = DashboardCache()
+
+
+@add_commit_listener
+def _update_dashboard(changes):
+    cache.apply_changes(changes)
@@ -1,9 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime, Float, ForeignKey
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, text, bindparam, inspect, Index, Column, Integer, String, Text, \
+    Boolean, DateTime, Float, ForeignKey
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.orm import aliased, sessionmaker, Session as OrmSession
+from sqlalchemy.pool import QueuePool, StaticPool
+from datetime import datetime, timedelta
+
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    SQLITE_BUSY_TIMEOUT_MS, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, \
+    REFERRAL_PERCENT, REFERRAL_PERCENT_PREMIUM, MIN_REFERRALS_FOR_PREMIUM
 
-DATABASE_URL = 'sqlite:///bot_orders.db'
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -19,6 +32,10 @@ class User(Base):
     join_date = Column(DateTime, default=datetime.now)
     is_partner = Column(Boolean, default=False)
 
+    __table_args__ = (
+        Index('ix_users_referral_id', 'referral_id'),
+    )
+
 class Order(Base):
     __tablename__ = 'orders'
 
@@ -35,26 +52,470 @@ class Order(Base):
     partner_percent = Column(Float, default=10.0)
     amount = Column(Float, default=100.0)
 
+    # Индексы под запросы бота и админки (см. migrations.py — те же имена)
+    __table_args__ = (
+        Index('ix_orders_user_created', 'user_id', 'created_at'),  # "Мои заказы"
+        Index('ix_orders_partner_status', 'partner_id', 'status'),  # статистика партнёра
+        Index('ix_orders_partner_created', 'partner_id', 'created_at'),  # фильтр по партнёру в админке
+        Index('ix_orders_status_created', 'status', 'created_at'),  # фильтр по статусу
+        Index('ix_orders_created_id', 'created_at', 'id'),  # последние заказы, keyset-пагинация
+    )
+
+class BotState(Base):
+    """Служебные значения бота (offset long polling и т.п.)"""
+    __tablename__ = 'bot_state'
+
+    key = Column(String(100), primary_key=True)
+    value = Column(Text)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class PartnerStats(Base):
+    """Статистика партнёра, обновляется в той же транзакции, что и users/orders"""
+    __tablename__ = 'partner_stats'
+
+    partner_id = Column(Integer, primary_key=True)
+    referral_count = Column(Integer, default=0, nullable=False)
+    total_orders = Column(Integer, default=0, nullable=False)
+    completed_orders = Column(Integer, default=0, nullable=False)
+    pending_commission = Column(Float, default=0.0, nullable=False)  # выполнено, не выплачено
+    paid_commission = Column(Float, default=0.0, nullable=False)
+
+class OutboundMessage(Base):
+    """Сообщения, которые не удалось отправить и нужно переотправить (см. outbound.py)"""
+    __tablename__ = 'outbound_messages'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    kwargs = Column(Text)  # JSON с параметрами send_message
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text)
+    next_attempt_at = Column(DateTime, default=datetime.now, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+class FSMRecord(Base):
+    """Состояние FSM aiogram (см. fsm_storage.py)"""
+    __tablename__ = 'fsm_states'
+
+    key = Column(String(200), primary_key=True)
+    state = Column(String(100))
+    data = Column(Text)  # JSON
+    updated_at = Column(DateTime, default=datetime.now, index=True)
+
+
+class ProcessedUpdate(Base):
+    """update_id, уже принятые вебхуком (см. dedup.py)"""
+    __tablename__ = 'processed_updates'
+
+    update_id = Column(Integer, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, default=datetime.now, index=True)
+
 # УДАЛИ КЛАСС PartnerPayment полностью если не нужен
 # class PartnerPayment(Base):
 #     __tablename__ = 'partner_payments'
 #     ...
 
+# ====== Движки и сессии ======
+# Один движок (и один пул соединений) на процесс для каждого URL.
+# Бот, админка и init_db берут его через get_engine().
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настройки SQLite для каждого нового соединения из пула"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def _create_engine(url):
+    if not url.startswith('sqlite'):
+        return create_engine(url, echo=False, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                             pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=True)
+
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        # In-memory база живёт в одном соединении
+        engine = create_engine(url, echo=False, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+    else:
+        # Соединения переиспользуются между потоками (Flask), поэтому check_same_thread=False
+        engine = create_engine(url, echo=False, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+                               max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                               connect_args={'check_same_thread': False,
+                                             'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000})
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def get_engine(url=DATABASE_URL):
+    """Возвращает общий для процесса движок для url (создаёт при первом обращении)"""
+    engine = _engines.get(url)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(url)
+            if engine is None:
+                engine = _create_engine(url)
+                _engines[url] = engine
+    return engine
+
+
+class _Session(OrmSession):
+    def commit(self):
+        # В пачке группового commit (writer.py) функции записи только сбрасывают
+        # изменения, а commit за всю пачку делает писатель
+        if self.info.get('group_commit'):
+            self.flush()
+        else:
+            super().commit()
+
+
+# expire_on_commit=False: объекты остаются читаемыми после commit/close,
+# хендлеры используют их уже после закрытия сессии
+Session = sessionmaker(bind=get_engine(), class_=_Session, expire_on_commit=False)
+
+
 def init_db():
-    engine = create_engine(DATABASE_URL, echo=False)
+    """Создаёт таблицы и применяет миграции к существующей базе"""
+    from migrations import migrate
+    import sql_instrumentation
+    import tracing
+
+    engine = get_engine()
     Base.metadata.create_all(engine)
+    migrate(engine)
+    sql_instrumentation.attach(engine)
+    tracing.attach(engine)
     return engine
 
-# ====== ДОБАВЬ ЭТО В КОНЕЦ ФАЙЛА database.py ======
 
 def get_session():
-    """Создает и возвращает новую сессию базы данных"""
-    engine = create_engine('sqlite:///bot_orders.db', echo=False)
-    Session = sessionmaker(bind=engine)
+    """Возвращает новую сессию на общем пуле соединений"""
     return Session()
 
+
+@contextmanager
+def session_scope():
+    """Сессия на одну единицу работы: commit при успехе, rollback при ошибке"""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# ====== Уведомления об изменениях ======
+# Кэши в памяти (страницы заказов, пользователи, дашборд) подписываются через
+# add_commit_listener и получают список (объект, 'insert'|'update'|'delete')
+# после успешного commit. Слушатели вызываются в потоке, где шёл commit;
+# commit_started() отдаёт им время начала этого commit.
+
+_commit_listeners = []
+_notifying = threading.local()
+
+
+def add_commit_listener(callback):
+    _commit_listeners.append(callback)
+    return callback
+
+
+def commit_started():
+    """time.monotonic() начала commit, о котором сейчас уведомляются слушатели.
+
+    Всё, что прочитано из базы раньше, этот commit точно не видело.
+    """
+    return getattr(_notifying, 'started', None)
+
+
+@event.listens_for(Session, 'before_commit')
+def _mark_commit_start(session):
+    if not session.in_nested_transaction():
+        session.info['commit_started'] = time.monotonic()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault('changes', [])
+    changes.extend((obj, 'insert') for obj in session.new)
+    changes.extend((obj, 'update') for obj in session.dirty if session.is_modified(obj))
+    changes.extend((obj, 'delete') for obj in session.deleted)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_changes(session):
+    # after_commit срабатывает и на RELEASE SAVEPOINT: слушатели ждут настоящего COMMIT
+    if session.in_nested_transaction():
+        return
+    started = session.info.pop('commit_started', None)
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    _notifying.started = started
+    try:
+        for callback in _commit_listeners:
+            try:
+                callback(changes)
+            except Exception:
+                logger.exception("Ошибка обработчика изменений %s", callback.__name__)
+    finally:
+        _notifying.started = None
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_changes(session):
+    # Откат SAVEPOINT убирает только свои изменения — это делает тот, кто его открыл
+    if session.in_nested_transaction():
+        return
+    session.info.pop('changes', None)
+    session.info.pop('commit_started', None)
+
+
+# ====== Статистика партнёров ======
+# partner_stats не пересчитывается при чтении: before_flush переводит каждое
+# изменение users/orders в приращения и применяет их в той же транзакции.
+# Массовые query.update()/delete() это обходят — после них нужен rebuild.
+
+_STATS_FIELDS = ('referral_count', 'total_orders', 'completed_orders', 'pending_commission', 'paid_commission')
+_ORDER_STATS_ATTRS = ('partner_id', 'status', 'amount', 'partner_percent', 'partner_paid')
+
+
+def _order_contribution(values):
+    """Вклад одного заказа в статистику его партнёра"""
+    completed = values['status'] == 'completed'
+    commission = (values['amount'] or 0) * (values['partner_percent'] or 0) / 100 if completed else 0.0
+    return {
+        'total_orders': 1,
+        'completed_orders': 1 if completed else 0,
+        'pending_commission': 0.0 if values['partner_paid'] else commission,
+        'paid_commission': commission if values['partner_paid'] else 0.0,
+    }
+
+
+def _current_values(obj, attrs, apply_defaults=False):
+    values = {attr: getattr(obj, attr) for attr in attrs}
+    if apply_defaults:
+        # У нового объекта ещё нет значений по умолчанию — они появятся только при INSERT
+        columns = obj.__table__.c
+        for attr, value in values.items():
+            default = columns[attr].default
+            if value is None and default is not None and default.is_scalar:
+                values[attr] = default.arg
+    return values
+
+
+def _previous_values(obj, attrs):
+    state = inspect(obj)
+    values = {}
+    for attr in attrs:
+        history = state.attrs[attr].history
+        values[attr] = history.deleted[0] if history.deleted else getattr(obj, attr)
+    return values
+
+
+def _add_delta(deltas, partner_id, changes, sign):
+    if partner_id is None:
+        return
+    delta = deltas.setdefault(partner_id, dict.fromkeys(_STATS_FIELDS, 0))
+    for field, value in changes.items():
+        delta[field] += sign * value
+
+
+def _collect_partner_deltas(session):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Order):
+            values = _current_values(obj, _ORDER_STATS_ATTRS, apply_defaults=True)
+            _add_delta(deltas, values['partner_id'], _order_contribution(values), 1)
+        elif isinstance(obj, User):
+            _add_delta(deltas, obj.referral_id, {'referral_count': 1}, 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Order) and session.is_modified(obj):
+            old = _previous_values(obj, _ORDER_STATS_ATTRS)
+            new = _current_values(obj, _ORDER_STATS_ATTRS)
+            if old != new:
+                _add_delta(deltas, old['partner_id'], _order_contribution(old), -1)
+                _add_delta(deltas, new['partner_id'], _order_contribution(new), 1)
+        elif isinstance(obj, User) and session.is_modified(obj):
+            old = _previous_values(obj, ('referral_id',))['referral_id']
+            if old != obj.referral_id:
+                _add_delta(deltas, old, {'referral_count': 1}, -1)
+                _add_delta(deltas, obj.referral_id, {'referral_count': 1}, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            values = _previous_values(obj, _ORDER_STATS_ATTRS)
+            _add_delta(deltas, values['partner_id'], _order_contribution(values), -1)
+        elif isinstance(obj, User):
+            _add_delta(deltas, _previous_values(obj, ('referral_id',))['referral_id'], {'referral_count': 1}, -1)
+    return deltas
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_partner_stats(session, flush_context, instances):
+    deltas = _collect_partner_deltas(session)
+    if not deltas:
+        return
+
+    table = PartnerStats.__table__
+    connection = session.connection()
+    for partner_id, delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        stmt = sqlite_insert(table).values(partner_id=partner_id, **delta)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.partner_id],
+            set_={field: table.c[field] + stmt.excluded[field] for field in _STATS_FIELDS}
+        )
+        connection.execute(stmt)
+
+
+_PARTNER_STATS_SELECT = """
+    SELECT partner_id,
+           SUM(referral_count) AS referral_count,
+           SUM(total_orders) AS total_orders,
+           SUM(completed_orders) AS completed_orders,
+           SUM(pending_commission) AS pending_commission,
+           SUM(paid_commission) AS paid_commission
+    FROM (
+        SELECT referral_id AS partner_id, COUNT(*) AS referral_count, 0 AS total_orders,
+               0 AS completed_orders, 0.0 AS pending_commission, 0.0 AS paid_commission
+        FROM users WHERE referral_id IS NOT NULL GROUP BY referral_id
+        UNION ALL
+        SELECT partner_id, 0, COUNT(*),
+               SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN status = 'completed' AND NOT COALESCE(partner_paid, 0)
+                        THEN COALESCE(amount, 0) * COALESCE(partner_percent, 0) / 100 ELSE 0 END),
+               SUM(CASE WHEN status = 'completed' AND COALESCE(partner_paid, 0)
+                        THEN COALESCE(amount, 0) * COALESCE(partner_percent, 0) / 100 ELSE 0 END)
+        FROM orders WHERE partner_id IS NOT NULL GROUP BY partner_id
+    )
+    GROUP BY partner_id
+"""
+
+
+def rebuild_partner_stats(connection):
+    """Пересчитывает partner_stats с нуля (connection — соединение или сессия)"""
+    connection.execute(text("DELETE FROM partner_stats"))
+    connection.execute(text(
+        "INSERT INTO partner_stats (partner_id, referral_count, total_orders, completed_orders, "
+        "pending_commission, paid_commission) " + _PARTNER_STATS_SELECT
+    ))
+
+
+def verify_partner_stats(session):
+    """Сравнивает partner_stats с пересчётом по users/orders, возвращает список расхождений"""
+    expected = {row.partner_id: row for row in session.execute(text(_PARTNER_STATS_SELECT))}
+    actual = {row.partner_id: row for row in session.query(PartnerStats)}
+    mismatches = []
+    for partner_id in sorted(set(expected) | set(actual)):
+        for field in _STATS_FIELDS:
+            want = getattr(expected[partner_id], field) if partner_id in expected else 0
+            have = getattr(actual[partner_id], field) if partner_id in actual else 0
+            if abs((want or 0) - (have or 0)) > 0.01:
+                mismatches.append((partner_id, field, want, have))
+    return mismatches
+
+
+
+# ====== Полнотекстовый поиск по заказам ======
+# orders_fts — FTS5-индекс по текстам анкеты с внешним содержимым (сами тексты
+# хранятся только в orders). Триггеры держат его в актуальном состоянии при
+# любой записи в orders, включая пакетные вставки через Core.
+
+_ORDER_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5("
+    "functionality, target_audience, preferences, "
+    "content='orders', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS orders_fts_ai AFTER INSERT ON orders BEGIN "
+    "INSERT INTO orders_fts (rowid, functionality, target_audience, preferences) "
+    "VALUES (new.id, new.functionality, new.target_audience, new.preferences); END",
+    "CREATE TRIGGER IF NOT EXISTS orders_fts_ad AFTER DELETE ON orders BEGIN "
+    "INSERT INTO orders_fts (orders_fts, rowid, functionality, target_audience, preferences) "
+    "VALUES ('delete', old.id, old.functionality, old.target_audience, old.preferences); END",
+    "CREATE TRIGGER IF NOT EXISTS orders_fts_au AFTER UPDATE OF functionality, target_audience, preferences "
+    "ON orders BEGIN "
+    "INSERT INTO orders_fts (orders_fts, rowid, functionality, target_audience, preferences) "
+    "VALUES ('delete', old.id, old.functionality, old.target_audience, old.preferences); "
+    "INSERT INTO orders_fts (rowid, functionality, target_audience, preferences) "
+    "VALUES (new.id, new.functionality, new.target_audience, new.preferences); END",
+]
+
+# Маркеры подсветки в snippet(): веб-слой экранирует текст и заменяет их на теги
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+
+def create_order_search(connection):
+    """Создаёт orders_fts и триггеры (если их ещё нет)"""
+    for statement in _ORDER_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+def rebuild_order_search(connection):
+    """Перестраивает orders_fts по текущему содержимому orders"""
+    create_order_search(connection)
+    connection.execute(text("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')"))
+
+
+def make_search_query(query):
+    """Пользовательский ввод -> запрос FTS5: все слова обязательны, каждое как префикс.
+
+    Слова берутся в кавычки, поэтому операторы FTS5 и спецсимволы во вводе
+    не ломают запрос.
+    """
+    words = re.findall(r'\w+', query or '')
+    return ' '.join(f'"{word}"*' for word in words[:20])
+
+
+def search_orders(session, query, page=0, per_page=50, status=None):
+    """Заказы по словам из анкеты, самые релевантные первыми (bm25).
+
+    Возвращает (строки, всего найдено); в строке — поля заказа, клиента и
+    snippet с маркерами SNIPPET_START/SNIPPET_END вокруг найденных слов.
+    """
+    match = make_search_query(query)
+    if not match:
+        return [], 0
+    params = {'match': match, 'status': status, 'start': SNIPPET_START, 'end': SNIPPET_END,
+              'limit': per_page, 'offset': page * per_page}
+    status_filter = "AND o.status = :status" if status else ""
+
+    total = session.execute(text(
+        "SELECT COUNT(*) FROM orders_fts JOIN orders o ON o.id = orders_fts.rowid "
+        f"WHERE orders_fts MATCH :match {status_filter}"
+    ), params).scalar()
+    if not total:
+        return [], 0
+
+    rows = session.execute(text(f"""
+        SELECT o.id, o.status, o.bot_type, o.amount, o.created_at,
+               u.first_name, u.last_name, u.username,
+               snippet(orders_fts, -1, :start, :end, '…', 16) AS snippet
+        FROM orders_fts
+        JOIN orders o ON o.id = orders_fts.rowid
+        LEFT JOIN users u ON u.id = o.user_id
+        WHERE orders_fts MATCH :match {status_filter}
+        ORDER BY bm25(orders_fts, 2.0, 1.0, 1.0), o.id DESC
+        LIMIT :limit OFFSET :offset
+    """).columns(created_at=DateTime), params).all()
+    return rows, total
+
+def get_user_by_telegram_id(session, telegram_id):
+    """Получает пользователя по telegram_id"""
+    return session.query(User).filter_by(telegram_id=telegram_id).first()
+
+
 def get_or_create_user(session, telegram_id, username=None, first_name=None, last_name=None, referral_code=None):
-    """Получает или создает пользователя"""
+    """Получает или создает пользователя (с привязкой к партнёру по referral_code)"""
     user = session.query(User).filter_by(telegram_id=telegram_id).first()
     
     if not user:
@@ -64,60 +525,80 @@ def get_or_create_user(session, telegram_id, username=None, first_name=None, las
             first_name=first_name,
             last_name=last_name
         )
+
+        if referral_code and str(referral_code).isdigit():
+            referrer = session.query(User).filter_by(id=int(referral_code)).first()
+            if referrer:
+                user.referral_id = referrer.id
+                referrer.is_partner = True
+                user.is_partner = True
+
         session.add(user)
         session.commit()
     
     return user
 
-def create_order(session, user_id, bot_type, functionality, target_audience, preferences, budget=100000, partner_id=None):
-    """Создает новый заказ"""
-    user = session.query(User).filter_by(id=user_id).first()
-    
-    # Определяем процент партнера
-    partner_percent = 0
-    if user.referral_id and not session.query(Order).filter_by(user_id=user_id).first():
-        partner_id = user.referral_id
-        partner = session.query(User).filter_by(id=partner_id).first()
-        
-        # Считаем рефералов
-        referral_count = session.query(User).filter_by(referral_id=partner_id).count()
-        
-        # Определяем процент
-        if referral_count >= 3:
-            partner_percent = 20.0
-        else:
-            partner_percent = 10.0
-    
+def _partner_percent(referral_count):
+    """Процент партнёра: премиальный при достаточном числе рефералов"""
+    if referral_count >= MIN_REFERRALS_FOR_PREMIUM:
+        return float(REFERRAL_PERCENT_PREMIUM)
+    return float(REFERRAL_PERCENT)
+
+
+def submit_order(session, telegram_id, username, first_name, last_name, bot_type, functionality, target_audience,
+                 preferences, budget=100000):
+    """Оформляет заказ из анкеты одной транзакцией.
+
+    Пользователь, его партнёр, число рефералов партнёра (из partner_stats) и
+    наличие прежних заказов читаются одним запросом, заказ (и пользователь,
+    если его ещё нет) записывается одним commit. Возвращает (order, user,
+    partner) — всё, что нужно для уведомлений; partner — None, если заказ
+    без партнёра.
+    """
+    partner_alias = aliased(User)
+    has_orders = session.query(Order.id).filter(Order.user_id == User.id).exists()
+    row = (session.query(User, partner_alias, PartnerStats.referral_count, has_orders)
+           .outerjoin(partner_alias, partner_alias.id == User.referral_id)
+           .outerjoin(PartnerStats, PartnerStats.partner_id == User.referral_id)
+           .filter(User.telegram_id == telegram_id)
+           .first())
+
+    if row is None:
+        # Анкету заполнили без /start (например, после очистки базы)
+        user = User(telegram_id=telegram_id, username=username, first_name=first_name, last_name=last_name)
+        session.add(user)
+        session.flush()
+        partner, referral_count, first_order = None, 0, True
+    else:
+        user, partner, referral_count, ordered_before = row
+        first_order = not ordered_before
+
+    # Партнёр получает процент только с первого заказа реферала
+    if partner is None or not first_order:
+        partner = None
     order = Order(
-        user_id=user_id,
-        partner_id=partner_id,
+        user_id=user.id,
+        partner_id=partner.id if partner else None,
         bot_type=bot_type,
         functionality=functionality,
         target_audience=target_audience,
         preferences=preferences,
         amount=budget,
-        partner_percent=partner_percent
+        partner_percent=_partner_percent(referral_count or 0) if partner else 0
     )
-    
     session.add(order)
     session.commit()
-    
-    return order
-
-
-def get_user_orders(session, user_id):
-    """Получает все заказы пользователя"""
-    return session.query(Order).filter_by(user_id=user_id).all()
 
+    return order, user, partner
 
-def get_all_orders(session):
-    """Получает все заказы"""
-    return session.query(Order).order_by(Order.created_at.desc()).all()
 
-
-def get_partners(session):
-    """Получает всех партнеров"""
-    return session.query(User).filter_by(is_partner=True).all()
+def get_user_orders_page(session, user_id, page, per_page):
+    """Страница заказов пользователя (новые сверху) и общее число заказов"""
+    query = session.query(Order).filter_by(user_id=user_id)
+    total = query.count()
+    orders = query.order_by(Order.created_at.desc(), Order.id.desc()) \
+        .offset(page * per_page).limit(per_page).all()
+    return orders, total
 
 
 def update_order_status(session, order_id, status):
@@ -130,14 +611,188 @@ def update_order_status(session, order_id, status):
     return False
 
 
+def delete_order(session, order_id):
+    """Удаляет заказ (через ORM, чтобы обновилась partner_stats)"""
+    order = session.query(Order).filter_by(id=order_id).first()
+    if order:
+        session.delete(order)
+        session.commit()
+        return True
+    return False
+
+
+def bulk_update_order_status(session, criteria, status, limit):
+    """Меняет статус всех заказов, подходящих под criteria, одним commit.
+
+    Заказы загружаются через ORM, чтобы обновились partner_stats и кэши.
+    Возвращает список id или None, если заказов больше limit.
+    """
+    orders = session.query(Order).filter(*criteria).limit(limit + 1).all()
+    if len(orders) > limit:
+        return None
+    for order in orders:
+        order.status = status
+    session.commit()
+    return [order.id for order in orders]
+
+
+def bulk_delete_orders(session, criteria, limit):
+    """Удаляет все заказы, подходящие под criteria, одним commit (см. bulk_update_order_status)"""
+    orders = session.query(Order).filter(*criteria).limit(limit + 1).all()
+    if len(orders) > limit:
+        return None
+    for order in orders:
+        session.delete(order)
+    session.commit()
+    return [order.id for order in orders]
+
+
 def get_partner_stats(session, partner_id):
-    """Статистика партнера"""
+    """Статистика партнера (одна строка partner_stats)"""
+    row = session.query(PartnerStats).filter_by(partner_id=partner_id).first()
     stats = {
-        'total_referrals': session.query(User).filter_by(referral_id=partner_id).count(),
-        'completed_orders': session.query(Order).filter_by(partner_id=partner_id, status='completed').count(),
-        'total_earnings': 0,
-        'pending_payments': 0
+        'total_referrals': row.referral_count if row else 0,
+        'completed_orders': row.completed_orders if row else 0,
+        'total_earnings': row.paid_commission if row else 0,
+        'pending_payments': row.pending_commission if row else 0
     }
     return stats
 
 
+def get_bot_state(session, key, default=None):
+    """Читает служебное значение из bot_state"""
+    row = session.query(BotState).filter_by(key=key).first()
+    return row.value if row else default
+
+
+def set_bot_state(session, key, value):
+    """Сохраняет служебное значение в bot_state"""
+    row = session.query(BotState).filter_by(key=key).first()
+    if row:
+        row.value = value
+    else:
+        session.add(BotState(key=key, value=value))
+    session.commit()
+
+
+def save_outbound_message(session, row_id, chat_id, text, kwargs, error, max_attempts):
+    """Сохраняет неотправленное сообщение. False — попытки исчерпаны, сообщение удалено"""
+    row = session.query(OutboundMessage).filter_by(id=row_id).first() if row_id else None
+    if row is None:
+        row = OutboundMessage(chat_id=chat_id, text=text, kwargs=kwargs, attempts=0)
+        session.add(row)
+
+    row.attempts += 1
+    row.last_error = error
+    if row.attempts >= max_attempts:
+        session.delete(row)
+        session.commit()
+        return False
+
+    # Экспоненциальная пауза: 1, 2, 4, 8... минут
+    row.next_attempt_at = datetime.now() + timedelta(minutes=2 ** (row.attempts - 1))
+    session.commit()
+    return True
+
+
+def take_due_outbound_messages(session, lease_seconds, limit=100):
+    """Забирает сообщения, которым пора на повторную отправку, и откладывает их на время lease"""
+    now = datetime.now()
+    rows = session.query(OutboundMessage).filter(OutboundMessage.next_attempt_at <= now) \
+        .order_by(OutboundMessage.id).limit(limit).all()
+    for row in rows:
+        row.next_attempt_at = now + timedelta(seconds=lease_seconds)
+    session.commit()
+    return [(row.id, row.chat_id, row.text, row.kwargs) for row in rows]
+
+
+def delete_outbound_message(session, row_id):
+    session.query(OutboundMessage).filter_by(id=row_id).delete()
+    session.commit()
+
+
+def get_fsm_record(session, key, newer_than):
+    """Возвращает (state, data_json, updated_at) или None, если записи нет или она старше newer_than"""
+    row = session.query(FSMRecord).filter(FSMRecord.key == key, FSMRecord.updated_at >= newer_than).first()
+    return (row.state, row.data, row.updated_at) if row else None
+
+
+def get_fsm_updated_at(session, key, newer_than):
+    """updated_at записи FSM — её версия для проверки кэша; None, если записи нет или она старше newer_than"""
+    return session.query(FSMRecord.updated_at) \
+        .filter(FSMRecord.key == key, FSMRecord.updated_at >= newer_than).scalar()
+
+
+def _fsm_upsert(fields):
+    """Upsert записи FSM, меняющий только fields; поля записи старше :newer_than сбрасываются"""
+    values = ', '.join(f':{name}' if name in fields else 'NULL' for name in ('state', 'data'))
+    updates = ', '.join(
+        f"{name} = excluded.{name}" if name in fields
+        else f"{name} = CASE WHEN fsm_states.updated_at < :newer_than THEN NULL ELSE fsm_states.{name} END"
+        for name in ('state', 'data'))
+    params = [bindparam('updated_at', type_=DateTime)]
+    if ':newer_than' in updates:
+        params.append(bindparam('newer_than', type_=DateTime))
+    return text(f"""
+        INSERT INTO fsm_states (key, state, data, updated_at) VALUES (:key, {values}, :updated_at)
+        ON CONFLICT (key) DO UPDATE SET {updates}, updated_at = excluded.updated_at
+    """).bindparams(*params)
+
+
+# Готовые text() вместо insert().on_conflict_do_update(): запись идёт на каждый шаг анкеты
+_FSM_UPSERTS = {fields: _fsm_upsert(fields)
+                for fields in (frozenset({'state'}), frozenset({'data'}), frozenset({'state', 'data'}))}
+_FSM_SELECT = text("SELECT state, data FROM fsm_states WHERE key = :key")
+
+
+def save_fsm_records(session, writes, updated_at, newer_than):
+    """Пишет изменённые поля записей FSM: writes — {key: {'state'/'data': значение}}.
+
+    Остальные поля не трогаются; поля записи старше newer_than считаются пустыми.
+    Возвращает {key: (state, data_json, updated_at)} после записи, None — запись
+    опустела и удалена.
+    """
+    rows = {}
+    for key, values in writes.items():
+        session.execute(_FSM_UPSERTS[frozenset(values)],
+                        dict(values, key=key, updated_at=updated_at, newer_than=newer_than))
+        state, data = session.execute(_FSM_SELECT, {'key': key}).one()
+        rows[key] = (state, data, updated_at)
+
+    empty = [key for key, (state, data, _) in rows.items() if state is None and data in (None, '{}')]
+    if empty:
+        session.query(FSMRecord).filter(FSMRecord.key.in_(empty)).delete(synchronize_session=False)
+        rows.update(dict.fromkeys(empty))
+    session.commit()
+    return rows
+
+
+def purge_fsm_records(session, older_than):
+    """Удаляет брошенные анкеты, не менявшиеся с older_than"""
+    count = session.query(FSMRecord).filter(FSMRecord.updated_at < older_than).delete(synchronize_session=False)
+    session.commit()
+    return count
+
+
+def get_processed_updates(session, newer_than, limit):
+    """update_id, принятые после newer_than, — последние limit штук"""
+    rows = (session.query(ProcessedUpdate.update_id, ProcessedUpdate.received_at)
+            .filter(ProcessedUpdate.received_at >= newer_than)
+            .order_by(ProcessedUpdate.received_at.desc())
+            .limit(limit)
+            .all())
+    return [(row.update_id, row.received_at) for row in reversed(rows)]
+
+
+def save_processed_updates(session, rows):
+    """Пакетная запись принятых апдейтов: rows — [(update_id, received_at)]"""
+    stmt = sqlite_insert(ProcessedUpdate.__table__).on_conflict_do_nothing(index_elements=['update_id'])
+    session.execute(stmt, [{'update_id': update_id, 'received_at': received_at} for update_id, received_at in rows])
+    session.commit()
+
+
+def purge_processed_updates(session, older_than):
+    count = (session.query(ProcessedUpdate).filter(ProcessedUpdate.received_at < older_than)
+             .delete(synchronize_session=False))
+    session.commit()
+    return count
@@ -0,0 +1,99 @@
+"""Отсев повторных доставок вебхука по update_id.
+
+Если ответ на вебхук задержался, Telegram доставляет тот же апдейт ещё раз,
+и без отсева получаются двойные заказы и двойные уведомления админу. Принятые
+update_id хранятся в LRU-кэше с TTL; повтор сразу получает 200 и до
+Dispatcher не доходит. С persist=True id пачками пишутся в processed_updates
+и подгружаются при старте, так что отсев переживает рестарт.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import database
+from async_db import run_db, run_write
+from config import WEBHOOK_DEDUP_SIZE, WEBHOOK_DEDUP_TTL, WEBHOOK_DEDUP_PERSIST
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    def __init__(self, maxsize=WEBHOOK_DEDUP_SIZE, ttl=WEBHOOK_DEDUP_TTL, persist=WEBHOOK_DEDUP_PERSIST,
+                 flush_interval=1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist = persist
+        self.flush_interval = flush_interval
+
+        self._seen = OrderedDict()  # update_id -> время приёма (time.time()), по порядку приёма
+        self._pending = []
+        self._flush_task = None
+        self.duplicates = 0
+
+    def seen(self, update_id):
+        """True, если апдейт уже принимался и не устарел"""
+        received = self._seen.get(update_id)
+        if received is None:
+            return False
+        if time.time() - received > self.ttl:
+            del self._seen[update_id]
+            return False
+        self.duplicates += 1
+        return True
+
+    def add(self, update_id):
+        """Отмечает апдейт принятым (вызывать только после успешной постановки в очередь)"""
+        now = time.time()
+        self._seen[update_id] = now
+        self._seen.move_to_end(update_id)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+        if self.persist:
+            self._pending.append((update_id, datetime.fromtimestamp(now)))
+
+    def stats(self):
+        return {'size': len(self._seen), 'maxsize': self.maxsize, 'duplicates': self.duplicates}
+
+    # ===== Хранение в базе =====
+
+    async def start(self):
+        if not self.persist:
+            return
+        rows = await run_db(database.get_processed_updates,
+                            datetime.now() - timedelta(seconds=self.ttl), self.maxsize)
+        for update_id, received_at in rows:
+            self._seen[update_id] = received_at.timestamp()
+        logger.info("Загружено принятых апдейтов: %s", len(rows))
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            await run_write(database.save_processed_updates, pending)
+        except Exception:
+            self._pending = pending + self._pending
+            raise
+
+    async def _flush_loop(self):
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_purge > min(self.ttl, 3600):
+                    older_than = datetime.now() - timedelta(seconds=self.ttl)
+                    await run_write(database.purge_processed_updates, older_than)
+                    last_purge = time.monotonic()
+            except Exception:
+                logger.exception("Ошибка записи принятых апдейтов в базу")
@@ -0,0 +1,201 @@
+"""Хранилище FSM aiogram в SQLite с кэшем в памяти.
+
+Изменения записываются в fsm_states до того, как закончится обработка
+апдейта: FSMWriteMiddleware копит их за апдейт и пишет одной операцией через
+поток-писатель, вне апдейта запись идёт сразу. Поэтому незаконченная анкета
+OrderForm переживает рестарт, а следующий апдейт чата может попасть в другой
+процесс бота. Кэш хранит разобранный JSON; при первом чтении за апдейт он
+сверяется с updated_at строки в базе одним запросом по первичному ключу, и
+запись, изменённая другим процессом, перечитывается. Анкеты, не менявшиеся
+FSM_STATE_TTL, удаляются.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import database
+from async_db import run_db, run_write
+from config import FSM_STATE_TTL, FSM_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Записи FSM текущего апдейта (см. FSMWriteMiddleware)
+_update_scope = contextvars.ContextVar('fsm_update_scope', default=None)
+
+
+class _UpdateScope:
+    __slots__ = ('records', 'writes')
+
+    def __init__(self):
+        self.records = {}  # key -> _Record, уже сверенные с базой или изменённые в этом апдейте
+        self.writes = {}  # key -> {'state'/'data': значение}, ещё не записанные
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at', 'touched')
+
+    def __init__(self, state=None, data=None, updated_at=None):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at  # версия строки в fsm_states; None — строки нет
+        self.touched = time.monotonic()
+
+
+def make_key(key: StorageKey):
+    return ':'.join(str(part) if part is not None else '' for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, ttl=FSM_STATE_TTL, cache_size=FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache_size = cache_size
+
+        self._cache = OrderedDict()  # key -> _Record, LRU
+        self._locks = {}
+        self._purge_task = None
+
+    # ===== BaseStorage =====
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._save(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data):
+        await self._save(key, data=json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey):
+        return (await self._get(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    # ===== Кэш =====
+
+    async def _get(self, key: StorageKey):
+        self._ensure_purge_task()
+        skey = make_key(key)
+        newer_than = datetime.now() - timedelta(seconds=self.ttl)
+
+        scope = _update_scope.get()
+        if scope is not None and skey in scope.records:
+            # Уже сверено в этом апдейте: следующий апдейт чата не начнётся, пока этот не закончится
+            return scope.records[skey]
+
+        # Один запрос в базу на ключ, даже если чтений несколько одновременно
+        lock = self._locks.setdefault(skey, asyncio.Lock())
+        async with lock:
+            record = self._cache.get(skey)
+            if record is not None:
+                updated_at = await run_db(database.get_fsm_updated_at, skey, newer_than)
+                if updated_at != record.updated_at:
+                    # Запись изменил другой процесс (или она устарела) — перечитаем
+                    record = None
+            if record is None:
+                record = self._store(skey, await run_db(database.get_fsm_record, skey, newer_than))
+            else:
+                self._cache.move_to_end(skey)
+        self._locks.pop(skey, None)
+        if scope is not None:
+            scope.records[skey] = record
+        return record
+
+    async def _save(self, key, **values):
+        """Изменение поля: копится до конца апдейта или, вне апдейта, пишется сразу"""
+        skey = make_key(key)
+        scope = _update_scope.get()
+        if scope is None:
+            await self.write({skey: values})
+            return
+        record = await self._get(key)
+        if 'state' in values:
+            record.state = values['state']
+        if 'data' in values:
+            record.data = json.loads(values['data'])
+        scope.writes.setdefault(skey, {}).update(values)
+
+    async def write(self, writes):
+        """Пишет {key: {'state'/'data': значение}} одной операцией; кэш получает строки после commit"""
+        self._ensure_purge_task()
+        newer_than = datetime.now() - timedelta(seconds=self.ttl)
+        try:
+            rows = await run_write(database.save_fsm_records, writes, datetime.now(), newer_than)
+        except Exception:
+            # В кэше могли остаться незаписанные изменения — следующее чтение возьмёт их из базы
+            for skey in writes:
+                self._cache.pop(skey, None)
+            raise
+        for skey, row in rows.items():
+            self._store(skey, row)
+
+    def _store(self, skey, row):
+        """Кладёт в кэш строку (state, data_json, updated_at) из базы; None — строки нет"""
+        record = _Record(row[0], json.loads(row[1]) if row[1] else None, row[2]) if row else _Record()
+        self._cache[skey] = record
+        self._cache.move_to_end(skey)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return record
+
+    def _expire(self):
+        """Удаляет из кэша брошенные анкеты"""
+        deadline = time.monotonic() - self.ttl
+        for skey in [skey for skey, record in self._cache.items() if record.touched < deadline]:
+            del self._cache[skey]
+
+    # ===== Очистка =====
+
+    def _ensure_purge_task(self):
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 3600))
+            try:
+                self._expire()
+                older_than = datetime.now() - timedelta(seconds=self.ttl)
+                purged = await run_write(database.purge_fsm_records, older_than)
+                if purged:
+                    logger.info("Удалено брошенных анкет: %s", purged)
+            except Exception:
+                logger.exception("Ошибка очистки FSM в базе")
+
+
+class FSMWriteMiddleware(BaseMiddleware):
+    """Внешняя middleware на dp.update: одна сверка с базой за апдейт и одна запись в конце"""
+
+    def __init__(self, storage: SQLiteStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        scope = _UpdateScope()
+        token = _update_scope.set(scope)
+        try:
+            return await handler(event, data)
+        finally:
+            _update_scope.reset(token)
+            if scope.writes:
+                await self.storage.write(scope.writes)
+
+
+def setup_fsm_writes(dp: Dispatcher):
+    """Подключает FSMWriteMiddleware снаружи FSM-middleware aiogram: её get_state — уже внутри апдейта"""
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(FSMWriteMiddleware(dp.fsm.storage))
+    dp.update.outer_middleware(dp.fsm)
@@ -1,45 +1,87 @@
 import asyncio
 import logging
 import os
+import signal
 
-from flask import Flask, request
+from aiohttp import web
 from aiogram import Bot, Dispatcher
-from aiogram.types import Update
 
-from config import BOT_TOKEN, WEBHOOK_URL
+from config import BOT_TOKEN, BOT_MODE, WEBHOOK_URL, WEBAPP_HOST, WEBAPP_PORT
+from bot_handlers import register_handlers
+from fsm_storage import SQLiteStorage, setup_fsm_writes
+from metrics import setup_handler_metrics
+from sql_instrumentation import SQLUnitMiddleware
+from throttling import setup_throttling
+from tracing import setup_tracing
+from outbound import scheduler
+from polling import PollingRunner
+from server import create_app
+from update_queue import UpdateQueue
 
 logging.basicConfig(level=logging.INFO)
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+storage = SQLiteStorage()
+dp = Dispatcher(storage=storage)
+register_handlers(dp)
+setup_fsm_writes(dp)
+setup_throttling(dp)
+setup_handler_metrics(dp)
+dp.update.outer_middleware(SQLUnitMiddleware())
+setup_tracing(dp, bot)
 
-# ===== Flask =====
-app = Flask(__name__)
+update_queue = UpdateQueue(dp, bot)
 
-@app.route("/ping", methods=["GET", "HEAD"])
-def ping():
-    return "OK", 200
 
-
-@app.route("/webhook", methods=["POST"])
-def telegram_webhook():
-    update = Update.model_validate(request.json)
-    asyncio.get_event_loop().create_task(dp.feed_update(bot, update))
-    return "OK", 200
+async def on_startup(app):
+    scheduler.start(bot)
+    update_queue.start()
+    await bot.set_webhook(WEBHOOK_URL)
+    logging.info("Webhook установлен")
 
 
-async def on_startup():
-    await bot.set_webhook(f"{WEBHOOK_URL}/webhook")
-    logging.info("Webhook установлен")
+async def on_shutdown(app):
+    await update_queue.stop()
+    await storage.close()
+    await scheduler.stop()
+    await bot.session.close()
 
 
 def run():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(on_startup())
+    # Вебхук, /ping, /health и админка — один процесс и один event loop
+    app = create_app(bot, update_queue)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+
+    port = int(os.environ.get("PORT", WEBAPP_PORT))
+    web.run_app(app, host=WEBAPP_HOST, port=port)
+
+
+async def run_polling():
+    # Админка и /health доступны и в режиме polling
+    runner = web.AppRunner(create_app(bot, update_queue))
+    await runner.setup()
+    port = int(os.environ.get("PORT", WEBAPP_PORT))
+    await web.TCPSite(runner, WEBAPP_HOST, port).start()
+
+    polling = PollingRunner(bot, dp, update_queue)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, polling.stop)
 
-    port = int(os.environ.get("PORT", 3000))
-    app.run(host="0.0.0.0", port=port)
+    scheduler.start(bot)
+    update_queue.start()
+    try:
+        await polling.run()
+    finally:
+        await storage.close()
+        await scheduler.stop()
+        await runner.cleanup()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
-    run()
+    if BOT_MODE == "polling":
+        asyncio.run(run_polling())
+    else:
+        run()
@@ -0,0 +1,53 @@
+"""Служебные команды для базы бота.
+
+    python manage.py partner-stats rebuild   # пересчитать partner_stats с нуля
+    python manage.py partner-stats verify    # сверить partner_stats с users/orders
+    python manage.py search rebuild          # перестроить полнотекстовый индекс заказов
+"""
+import argparse
+import sys
+
+from database import init_db, session_scope, rebuild_partner_stats, verify_partner_stats, rebuild_order_search
+
+
+def cmd_partner_stats(args):
+    if args.action == 'rebuild':
+        with session_scope() as session:
+            rebuild_partner_stats(session)
+        print("partner_stats пересчитана")
+        return 0
+
+    with session_scope() as session:
+        mismatches = verify_partner_stats(session)
+    for partner_id, field, expected, actual in mismatches:
+        print(f"Партнёр {partner_id}: {field} = {actual}, ожидалось {expected}")
+    print("Расхождений нет" if not mismatches else f"Расхождений: {len(mismatches)}")
+    return 1 if mismatches else 0
+
+
+def cmd_search(args):
+    with session_scope() as session:
+        rebuild_order_search(session)
+    print("orders_fts перестроена")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    partner_stats = commands.add_parser('partner-stats', help='статистика партнёров')
+    partner_stats.add_argument('action', choices=['rebuild', 'verify'])
+    partner_stats.set_defaults(func=cmd_partner_stats)
+
+    search = commands.add_parser('search', help='полнотекстовый поиск по заказам')
+    search.add_argument('action', choices=['rebuild'])
+    search.set_defaults(func=cmd_search)
+
+    args = parser.parse_args(argv)
+    init_db()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""Метрики в текстовом формате Prometheus (/metrics).
+
+Свой минимальный реестр вместо prometheus_client: нужны только счётчики,
+гистограммы и снимки состояния (очередь, пул БД, исходящие), которые
+собираются в момент запроса /metrics.
+"""
+import threading
+import time
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}  # key -> [counts по бакетам, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket', labels, cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, key), total
+            yield f'{self.name}_count', _format_labels(self.labelnames, key), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, name, collect):
+        """collect() -> [(metric_name, type, help, [(labels_dict, value)])], вызывается при каждом /metrics"""
+        self._collectors[name] = collect
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+
+        for collect in list(self._collectors.values()):
+            for name, metric_type, documentation, samples in collect():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    labels = labels or {}
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HANDLER_DURATION = registry.histogram(
+    'bot_handler_duration_seconds', 'Время работы хендлера aiogram', ('handler', 'state'))
+HANDLER_ERRORS = registry.counter(
+    'bot_handler_errors_total', 'Исключения в хендлерах aiogram', ('handler', 'state'))
+HTTP_DURATION = registry.histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP-запроса', ('method', 'route', 'status'))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренняя middleware: к этому моменту известен выбранный хендлер"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        state = data.get('raw_state') or ''
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name, state=state)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=name, state=state)
+
+
+def setup_handler_metrics(dp: Dispatcher):
+    """Подключает метрики ко всем хендлерам из register_handlers"""
+    middleware = HandlerMetricsMiddleware()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+
+
+def collect_db_pool():
+    from database import get_engine
+
+    pool = get_engine().pool
+    samples = []
+    for name, attr in (('size', 'size'), ('checked_out', 'checkedout'), ('checked_in', 'checkedin'),
+                       ('overflow', 'overflow')):
+        if hasattr(pool, attr):
+            samples.append(({'kind': name}, getattr(pool, attr)()))
+    return [('db_pool_connections', 'gauge', 'Соединения пула SQLAlchemy', samples)]
+
+
+def collect_update_queue(update_queue):
+    def collect():
+        stats = update_queue.stats()
+        return [
+            ('update_queue_depth', 'gauge', 'Апдейтов в очереди', [({}, stats['depth'])]),
+            ('update_queue_in_progress', 'gauge', 'Чатов в обработке', [({}, stats['in_progress'])]),
+            ('update_queue_lag_seconds', 'gauge', 'Возраст самого старого апдейта в очереди', [({}, stats['lag'])]),
+            ('update_queue_updates_total', 'counter', 'Апдейты по результату обработки', [
+                ({'result': 'processed'}, stats['processed']),
+                ({'result': 'failed'}, stats['failed']),
+                ({'result': 'rejected'}, stats['rejected']),
+            ]),
+        ]
+    return collect
+
+
+def collect_outbound():
+    from outbound import scheduler
+
+    stats = scheduler.stats()
+    return [
+        ('outbound_queue_depth', 'gauge', 'Сообщений в очереди отправки', [({}, stats['queued'])]),
+        ('outbound_messages_total', 'counter', 'Исходящие сообщения по результату', [
+            ({'result': 'sent'}, stats['sent']),
+            ({'result': 'failed'}, stats['failed']),
+            ({'result': 'retried'}, stats['retried']),
+            ({'result': 'persisted'}, stats['persisted']),
+        ]),
+    ]
+
+
+def collect_dedup(deduplicator):
+    def collect():
+        stats = deduplicator.stats()
+        return [
+            ('webhook_dedup_cache_size', 'gauge', 'update_id в кэше дедупликации', [({}, stats['size'])]),
+            ('webhook_duplicate_updates_total', 'counter', 'Отброшенные повторные доставки вебхука',
+             [({}, stats['duplicates'])]),
+        ]
+    return collect
+
+
+def collect_user_cache():
+    from user_cache import cache
+
+    stats = cache.stats()
+    return [
+        ('user_cache_size', 'gauge', 'Пользователей в кэше', [({}, stats['size'])]),
+        ('user_cache_requests_total', 'counter', 'Обращения к кэшу пользователей', [
+            ({'result': 'hit'}, stats['hits']),
+            ({'result': 'miss'}, stats['misses']),
+        ]),
+    ]
@@ -0,0 +1,56 @@
+"""Версионные миграции схемы SQLite.
+
+create_all() создаёт только отсутствующие таблицы и не трогает существующие,
+поэтому изменения схемы для уже работающих bot_orders.db описываются здесь.
+Текущая версия хранится в PRAGMA user_version; init_db() применяет при старте
+все миграции с номером больше неё. Шаг миграции — SQL-строка или функция,
+принимающая соединение. Миграции должны быть идемпотентными: на новой базе
+create_all уже мог создать те же объекты.
+"""
+import logging
+
+import database
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    (1, "Индексы для заказов и рефералов", [
+        "CREATE INDEX IF NOT EXISTS ix_users_referral_id ON users (referral_id)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_user_created ON orders (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_partner_status ON orders (partner_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_partner_created ON orders (partner_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_status_created ON orders (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_created_id ON orders (created_at, id)",
+        "ANALYZE",
+    ]),
+    (2, "Заполнение partner_stats по существующим данным", [
+        lambda connection: database.rebuild_partner_stats(connection),
+    ]),
+    (3, "Полнотекстовый поиск по заказам (orders_fts)", [
+        lambda connection: database.rebuild_order_search(connection),
+    ]),
+]
+
+
+def get_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine):
+    """Применяет недостающие миграции, каждую в своей транзакции"""
+    with engine.connect() as connection:
+        current = get_version(connection)
+
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Миграция %s: %s", version, description)
+        with engine.begin() as connection:
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.exec_driver_sql(step)
+            connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+        current = version
+    return current
@@ -0,0 +1,331 @@
+"""Планировщик исходящих сообщений Bot API.
+
+Все отправки идут через один SendScheduler: token bucket на весь бот
+(лимит Telegram ~30 сообщений/с) и на каждый чат (~1/с в личке, 20/мин в
+группе). Сообщения одного чата уходят в порядке постановки, разных чатов —
+параллельно несколькими воркерами. Как в UpdateQueue, у каждого чата своя
+очередь, а воркеры берут чаты, готовые к отправке: чат без токена или под
+RetryAfter откладывается по таймеру и не держит воркер, пока у других чатов
+есть что отправлять. RetryAfter от Telegram выдерживается автоматически. Сообщения с persist=True, которые не удалось доставить,
+сохраняются в outbound_messages и переотправляются позже, в том числе
+после рестарта.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+import database
+from async_db import run_write
+from config import OUTBOUND_WORKERS, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, \
+    OUTBOUND_GROUP_RATE, OUTBOUND_MAX_ATTEMPTS, OUTBOUND_RETRY_INTERVAL
+from tracing import current_span, start_span, use_span
+
+logger = logging.getLogger(__name__)
+
+# Попыток внутри одной доставки при сетевых ошибках, до сохранения в outbound_messages
+IMMEDIATE_ATTEMPTS = 3
+MAX_CHAT_BUCKETS = 10000
+
+_captured_replies = contextvars.ContextVar('captured_replies', default=None)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def try_acquire(self):
+        """Берёт токен, если он есть, без ожидания"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self):
+        """Берёт токен, если он есть (0), иначе — через сколько секунд он появится"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ('bot', 'chat_id', 'text', 'kwargs', 'persist', 'future', 'row_id', 'span', 'attempts')
+
+    def __init__(self, bot, chat_id, text, kwargs, persist, future=None, row_id=None, span=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.persist = persist
+        self.future = future
+        self.row_id = row_id
+        self.span = span  # span апдейта, из которого отправлено сообщение
+        self.attempts = 0  # неудачных попыток из-за сети в этой доставке
+
+
+class SendScheduler:
+    def __init__(self, workers=OUTBOUND_WORKERS, global_rate=OUTBOUND_GLOBAL_RATE):
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bot = None
+
+        self._pending = {}  # chat_id -> deque[_Job]; первое сообщение чата остаётся там до конца отправки
+        self._ready = None  # чаты, которые можно отправлять прямо сейчас
+        self._timers = {}  # chat_id -> TimerHandle: чат ждёт токена или RetryAfter
+        self._size = 0
+        self._tasks = []
+        self._chat_buckets = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.persisted = 0
+
+    # ===== Публичный API =====
+
+    async def send_message(self, bot: Bot, chat_id, text, wait=True, persist=False, **kwargs):
+        """Ставит сообщение в очередь отправки.
+
+        wait=True — дождаться отправки и вернуть Message (ошибка доставки пробрасывается);
+        wait=False — вернуть сразу. persist=True — при неудаче сохранить для повторной отправки.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._enqueue(_Job(bot, chat_id, text, kwargs, persist, future, span=current_span()))
+        if future is not None:
+            return await future
+
+    def start(self, bot: Bot = None):
+        """Запускает воркеров; bot нужен для переотправки сохранённых сообщений"""
+        if bot is not None:
+            self.bot = bot
+        self._ensure_started()
+
+    async def stop(self, drain=True, timeout=10):
+        """Останавливает воркеров, по умолчанию дождавшись отправки очереди.
+
+        Неотправленные persist-сообщения сохраняются в базу, остальные отменяются.
+        """
+        if drain:
+            deadline = time.monotonic() + timeout
+            while self._size and self._tasks and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+        pending, self._pending, self._size = self._pending, {}, 0
+        for jobs in pending.values():
+            for job in jobs:
+                if job.persist:
+                    await self._persist(job, "остановка планировщика")
+                    self._resolve(job, None)
+                elif job.future is not None and not job.future.done():
+                    job.future.cancel()
+
+    def stats(self):
+        return {
+            'queued': self._size,
+            'chats': len(self._pending),
+            'delayed': len(self._timers),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'persisted': self.persisted,
+        }
+
+    # ===== Внутреннее =====
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._retry_loop()))
+
+    def _enqueue(self, job):
+        pending = self._pending.get(job.chat_id)
+        if pending is None:
+            pending = self._pending[job.chat_id] = deque()
+        pending.append(job)
+        self._size += 1
+        # Чат с другими сообщениями уже в _ready, в работе или ждёт таймера
+        if len(pending) == 1:
+            self._ready.put_nowait(job.chat_id)
+
+    def _defer(self, chat_id, delay):
+        """Возвращает чат в _ready через delay секунд; воркер тем временем берёт другие чаты"""
+        self._timers[chat_id] = asyncio.get_running_loop().call_later(delay, self._wake, chat_id)
+
+    def _wake(self, chat_id):
+        del self._timers[chat_id]
+        self._ready.put_nowait(chat_id)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                # Полные корзины ничего не ограничивают — их можно выбросить
+                for key in [key for key, b in self._chat_buckets.items() if b.is_full()]:
+                    del self._chat_buckets[key]
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE, max(1, OUTBOUND_GROUP_RATE * 60))
+            else:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            delay = self._chat_bucket(chat_id).reserve()
+            if not delay:
+                pending = self._pending[chat_id]
+                try:
+                    delay = await self._send(pending[0])
+                except Exception as e:
+                    # Сбой базы при сохранении: сообщение теряется, но чат не застревает
+                    logger.exception("Ошибка отправки в чат %s", chat_id)
+                    self._resolve(pending[0], exc=e)
+                    delay = None
+                if delay is None:
+                    pending.popleft()
+                    self._size -= 1
+                    if not pending:
+                        del self._pending[chat_id]
+                        continue
+            if delay:
+                self._defer(chat_id, delay)
+            else:
+                # Следующее сообщение чата — в конец очереди, чтобы не держать воркер за одним чатом
+                self._ready.put_nowait(chat_id)
+
+    async def _send(self, job):
+        """Одна попытка отправки. Пауза перед повтором или None, если с сообщением покончено"""
+        await self.global_bucket.acquire()
+        try:
+            with use_span(job.span), start_span('outbound.send', chat_id=job.chat_id):
+                message = await job.bot.send_message(job.chat_id, job.text, **job.kwargs)
+        except asyncio.CancelledError:
+            raise
+        except TelegramRetryAfter as e:
+            self.retried += 1
+            logger.warning("Flood control для чата %s, ждём %s с", job.chat_id, e.retry_after)
+            return e.retry_after
+        except Exception as e:
+            if isinstance(e, (TelegramNetworkError, TelegramServerError)):
+                job.attempts += 1
+                if job.attempts < IMMEDIATE_ATTEMPTS:
+                    self.retried += 1
+                    return 2 ** job.attempts
+            self.failed += 1
+            logger.warning("Не удалось отправить сообщение в чат %s: %s", job.chat_id, e)
+            if job.persist and isinstance(e, (TelegramNetworkError, TelegramServerError)):
+                await self._persist(job, str(e))
+                self._resolve(job, None)
+            else:
+                if job.row_id is not None:
+                    await run_write(database.delete_outbound_message, job.row_id)
+                self._resolve(job, exc=e)
+            return None
+
+        self.sent += 1
+        if job.row_id is not None:
+            await run_write(database.delete_outbound_message, job.row_id)
+        self._resolve(job, message)
+        return None
+
+    @staticmethod
+    def _resolve(job, result=None, exc=None):
+        if job.future is None or job.future.done():
+            return
+        if exc is not None:
+            job.future.set_exception(exc)
+        else:
+            job.future.set_result(result)
+
+    async def _persist(self, job, error):
+        kwargs = {key: (value.model_dump(exclude_none=True) if hasattr(value, 'model_dump') else value)
+                  for key, value in job.kwargs.items()}
+        saved = await run_write(database.save_outbound_message, job.row_id, job.chat_id, job.text,
+                             json.dumps(kwargs, ensure_ascii=False), error, OUTBOUND_MAX_ATTEMPTS)
+        if saved:
+            self.persisted += 1
+        else:
+            logger.error("Сообщение в чат %s не доставлено после %s попыток", job.chat_id, OUTBOUND_MAX_ATTEMPTS)
+
+    async def _retry_loop(self):
+        while True:
+            await asyncio.sleep(OUTBOUND_RETRY_INTERVAL)
+            if self.bot is None:
+                continue
+            try:
+                rows = await run_write(database.take_due_outbound_messages, OUTBOUND_RETRY_INTERVAL * 2)
+            except Exception:
+                logger.exception("Не удалось прочитать outbound_messages")
+                continue
+            for row_id, chat_id, text, kwargs in rows:
+                self._enqueue(_Job(self.bot, chat_id, text, json.loads(kwargs or '{}'), True, row_id=row_id))
+
+
+scheduler = SendScheduler()
+
+
+async def send_message(bot: Bot, chat_id, text, **kwargs):
+    return await scheduler.send_message(bot, chat_id, text, **kwargs)
+
+
+@contextmanager
+def capture_replies():
+    """Собирает ответы answer() внутри блока в список [(text, kwargs)] (см. throttling.py)"""
+    replies = []
+    token = _captured_replies.set(replies)
+    try:
+        yield replies
+    finally:
+        _captured_replies.reset(token)
+
+
+async def answer(message, text, wait=False, **kwargs):
+    """Аналог message.answer(), но через планировщик.
+
+    По умолчанию не ждёт доставки: хендлер не держит воркер UpdateQueue, пока
+    чат ждёт токена или RetryAfter. wait=True — дождаться и вернуть Message.
+    """
+    replies = _captured_replies.get()
+    if replies is not None:
+        replies.append((text, kwargs))
+    return await scheduler.send_message(message.bot, message.chat.id, text, wait=wait, **kwargs)
@@ -0,0 +1,108 @@
+"""Long polling для BOT_MODE = "polling" (staging и резервные узлы без публичного URL).
+
+getUpdates забирает пачки до POLLING_LIMIT апдейтов, которые сразу уходят в
+UpdateQueue: следующий запрос идёт параллельно с обработкой предыдущей пачки.
+Offset хранится в таблице bot_state, поэтому после рестарта бот продолжает
+с того же места. При остановке очередь дообрабатывается, offset подтверждается.
+"""
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, \
+    TelegramConflictError
+
+import database
+from async_db import run_db, run_write
+from config import POLLING_LIMIT, POLLING_TIMEOUT
+from update_queue import UpdateQueue
+
+logger = logging.getLogger(__name__)
+
+OFFSET_KEY = 'polling_offset'
+MAX_BACKOFF = 30
+
+
+class PollingRunner:
+    def __init__(self, bot: Bot, dp: Dispatcher, update_queue: UpdateQueue,
+                 limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT):
+        self.bot = bot
+        self.dp = dp
+        self.update_queue = update_queue
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = None
+        self._stop = asyncio.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    async def _load_offset(self):
+        value = await run_db(database.get_bot_state, OFFSET_KEY)
+        return int(value) if value else None
+
+    async def _save_offset(self):
+        await run_write(database.set_bot_state, OFFSET_KEY, str(self.offset))
+
+    async def _get_updates(self, allowed_updates):
+        """getUpdates, прерываемый вызовом stop()"""
+        fetch = asyncio.ensure_future(self.bot.get_updates(
+            offset=self.offset,
+            limit=self.limit,
+            timeout=self.timeout,
+            allowed_updates=allowed_updates,
+            request_timeout=self.timeout + 10,
+        ))
+        stop = asyncio.ensure_future(self._stop.wait())
+        await asyncio.wait({fetch, stop}, return_when=asyncio.FIRST_COMPLETED)
+        if not fetch.done():
+            fetch.cancel()
+            await asyncio.gather(fetch, return_exceptions=True)
+            return []
+        stop.cancel()
+        return fetch.result()
+
+    async def _enqueue(self, updates):
+        for update in updates:
+            # При переполнении очереди ждём, а не отбрасываем: в polling Telegram сам хранит хвост
+            while not self.update_queue.submit(update):
+                await asyncio.sleep(0.05)
+            self.offset = update.update_id + 1
+
+    async def run(self):
+        await self.bot.delete_webhook(drop_pending_updates=False)
+        self.offset = await self._load_offset()
+        allowed_updates = self.dp.resolve_used_update_types()
+        logger.info("Polling запущен, offset=%s", self.offset)
+
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                updates = await self._get_updates(allowed_updates)
+            except TelegramRetryAfter as e:
+                logger.warning("getUpdates: flood control, ждём %s с", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError, TelegramConflictError) as e:
+                logger.warning("getUpdates: %s, повтор через %s с", e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+
+            backoff = 1
+            if updates:
+                await self._enqueue(updates)
+                await self._save_offset()
+
+        await self.shutdown()
+
+    async def shutdown(self):
+        """Дообрабатывает очередь и подтверждает offset в Telegram"""
+        await self.update_queue.stop(drain=True)
+        if self.offset is not None:
+            await self._save_offset()
+            try:
+                await self.bot.get_updates(offset=self.offset, limit=1, timeout=0)
+            except Exception as e:
+                logger.warning("Не удалось подтвердить offset %s: %s", self.offset, e)
+        logger.info("Polling остановлен, offset=%s", self.offset)
@@ -1,7 +1,257 @@
-from flask import Flask
+"""Единый HTTP-сервер на aiohttp.
 
-app = Flask(__name__)
+В одном процессе и одном event loop обслуживает вебхук Telegram, /ping,
+/health и админку. Админка (Flask-приложение из webapp.py) подключается
+через WSGI-мост и выполняется в отдельном пуле потоков, вебхук же
+обрабатывается прямо в event loop без перехода между потоками.
+"""
+import asyncio
+import io
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-@app.route("/ping", methods=["GET", "HEAD"])
-def ping():
-    return "OK", 200
+from aiohttp import web
+from aiogram import Bot
+from aiogram.types import Update
+from pydantic import ValidationError
+
+import metrics
+from dedup import UpdateDeduplicator
+from config import ADMIN_WORKERS, UPDATE_OVERLOAD_POLICY
+from update_queue import UpdateQueue
+
+logger = logging.getLogger(__name__)
+
+# Заголовки, которые aiohttp выставляет сам
+_SKIP_RESPONSE_HEADERS = {'connection', 'transfer-encoding', 'keep-alive'}
+
+
+class _StreamAborted(Exception):
+    """Клиент отключился, генерацию ответа WSGI-приложения нужно прервать"""
+
+
+def _resolve(future, result=None, exc=None):
+    if future.done():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class WSGIHandler:
+    """Запускает WSGI-приложение в пуле потоков и стримит его ответ через aiohttp"""
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    def _make_environ(self, request: web.Request, body: bytes):
+        host, _, port = request.host.partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            # Сырая строка запроса: request.query_string уже раскодирован и не в Latin-1
+            'QUERY_STRING': request.rel_url.raw_query_string,
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.scheme == 'https' else '80'),
+            'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+            'REMOTE_ADDR': request.remote or '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name in request.headers.keys():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH') or key in environ:
+                continue
+            environ[key] = ','.join(request.headers.getall(name))
+        return environ
+
+    async def __call__(self, request: web.Request):
+        loop = asyncio.get_running_loop()
+        body = await request.read()
+        environ = self._make_environ(request, body)
+
+        started = loop.create_future()
+        chunks = asyncio.Queue(maxsize=16)
+        aborted = False
+
+        def start_response(status, headers, exc_info=None):
+            loop.call_soon_threadsafe(_resolve, started, (status, headers))
+            return self._write_unsupported
+
+        def put(chunk):
+            if aborted:
+                raise _StreamAborted()
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+        def run():
+            # Весь ответ генерируется в одном потоке: stream_with_context этого требует
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except _StreamAborted:
+                pass
+            except Exception as e:
+                loop.call_soon_threadsafe(_resolve, started, None, e)
+                logger.exception("Ошибка WSGI-приложения на %s", environ['PATH_INFO'])
+            finally:
+                if not aborted:
+                    asyncio.run_coroutine_threadsafe(chunks.put(None), loop).result()
+
+        task = loop.run_in_executor(self.executor, run)
+        status, headers = await started
+        code, _, reason = status.partition(' ')
+
+        response = web.StreamResponse(status=int(code), reason=reason or None)
+        for name, value in headers:
+            if name.lower() not in _SKIP_RESPONSE_HEADERS:
+                response.headers.add(name, value)
+
+        try:
+            await response.prepare(request)
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                await response.write(chunk)
+        except (ConnectionResetError, asyncio.CancelledError):
+            aborted = True
+            # Разблокируем поток, если он ждёт места в очереди
+            while not chunks.empty():
+                chunks.get_nowait()
+            raise
+        await task
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def _write_unsupported(data):
+        raise NotImplementedError("write() из start_response не поддерживается")
+
+
+def _route_label(request: web.Request, status):
+    """Имя маршрута для метрик: у админки id в пути заменяются на {id}"""
+    if status == 404:
+        return 'unmatched'
+    if 'tail' in request.match_info:
+        return re.sub(r'/\d+', '/{id}', request.path)
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else request.path
+
+
+@web.middleware
+async def http_metrics_middleware(request: web.Request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.HTTP_DURATION.observe(time.perf_counter() - started, method=request.method,
+                                      route=_route_label(request, status), status=status)
+
+
+async def ping(request: web.Request):
+    return web.Response(text="OK")
+
+
+async def health_check(request: web.Request):
+    update_queue = request.app['update_queue']
+    return web.json_response({
+        'status': 'ok',
+        'update_queue': update_queue.stats(),
+        'dedup': request.app['deduplicator'].stats(),
+    })
+
+
+async def metrics_endpoint(request: web.Request):
+    return web.Response(body=metrics.registry.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def telegram_webhook(request: web.Request):
+    bot = request.app['bot']
+    update_queue = request.app['update_queue']
+    deduplicator = request.app['deduplicator']
+
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except (ValueError, ValidationError) as e:
+        # Не JSON или не Update: повтор от Telegram не поможет
+        logger.warning("Некорректное тело вебхука: %s", e)
+        return web.Response(status=400, text="Bad Request")
+    if deduplicator.seen(update.update_id):
+        # Повторная доставка: апдейт уже в работе или обработан
+        return web.Response(text="OK")
+    if not update_queue.submit(update):
+        logger.warning("Очередь апдейтов переполнена, update_id=%s", update.update_id)
+        if UPDATE_OVERLOAD_POLICY == "reject":
+            # Telegram повторит доставку позже
+            return web.Response(status=429, text="Too Many Requests")
+        return web.Response(text="OK")
+    deduplicator.add(update.update_id)
+    return web.Response(text="OK")
+
+
+def create_app(bot: Bot, update_queue: UpdateQueue, admin_app=None, deduplicator=None):
+    """Собирает aiohttp-приложение; admin_app — WSGI-приложение админки (по умолчанию webapp.app)"""
+    if admin_app is None:
+        from webapp import app as admin_app
+    if deduplicator is None:
+        deduplicator = UpdateDeduplicator()
+
+    app = web.Application(middlewares=[http_metrics_middleware])
+    app['bot'] = bot
+    app['update_queue'] = update_queue
+    app['deduplicator'] = deduplicator
+
+    metrics.registry.add_collector('db_pool', metrics.collect_db_pool)
+    metrics.registry.add_collector('update_queue', metrics.collect_update_queue(update_queue))
+    metrics.registry.add_collector('outbound', metrics.collect_outbound)
+    metrics.registry.add_collector('user_cache', metrics.collect_user_cache)
+    metrics.registry.add_collector('dedup', metrics.collect_dedup(deduplicator))
+
+    app.router.add_post('/webhook', telegram_webhook)
+    app.router.add_get('/ping', ping)
+    app.router.add_get('/health', health_check, allow_head=True)
+    app.router.add_get('/metrics', metrics_endpoint)
+
+    # Всё остальное — админка
+    executor = ThreadPoolExecutor(max_workers=ADMIN_WORKERS, thread_name_prefix='admin')
+    app.router.add_route('*', '/{tail:.*}', WSGIHandler(admin_app, executor))
+
+    async def start_deduplicator(app):
+        await deduplicator.start()
+
+    async def shutdown_executor(app):
+        executor.shutdown(wait=False)
+
+    async def stop_deduplicator(app):
+        await deduplicator.stop()
+
+    app.on_startup.append(start_deduplicator)
+    app.on_cleanup.append(shutdown_executor)
+    app.on_cleanup.append(stop_deduplicator)
+    return app
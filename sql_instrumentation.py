@@ -0,0 +1,164 @@
+"""Инструментирование SQL: счётчики на единицу работы, поиск N+1, лог медленных запросов.
+
+Единица работы — один апдейт (middleware на dp.update) или один запрос
+админки (хуки Flask). Внутри неё считаются запросы и их суммарное время;
+если один и тот же SQL (с разными параметрами — типичный N+1, как поиск
+пользователя для каждого заказа) выполняется SQL_REPEAT_THRESHOLD раз и
+больше, пишется предупреждение с местом вызова. Запросы дольше
+SQL_SLOW_QUERY_MS попадают в лог медленных запросов одной JSON-строкой.
+
+Выключено по умолчанию; включается через SQL_INSTRUMENTATION=1 или на лету
+через enable()/disable() (POST /api/debug/sql в админке). В выключенном
+состоянии обработчики событий сразу возвращаются.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from sqlalchemy import event
+
+from config import SQL_INSTRUMENTATION, SQL_SLOW_QUERY_MS, SQL_REPEAT_THRESHOLD, SQL_SLOW_LOG_FILE
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('sql.slow')
+if SQL_SLOW_LOG_FILE:
+    _handler = logging.FileHandler(SQL_SLOW_LOG_FILE, encoding='utf-8')
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    slow_logger.addHandler(_handler)
+    slow_logger.propagate = False
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKIP_FILES = {os.path.abspath(__file__)}
+
+_settings = {
+    'enabled': SQL_INSTRUMENTATION,
+    'slow_query_ms': SQL_SLOW_QUERY_MS,
+    'repeat_threshold': SQL_REPEAT_THRESHOLD,
+}
+_current_unit = contextvars.ContextVar('sql_unit', default=None)
+_attached = set()
+
+
+class UnitOfWork:
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.total_time = 0.0
+        self.statements = {}  # SQL -> число выполнений
+        self.flagged = set()
+        self._lock = threading.Lock()
+
+    def record(self, statement, duration):
+        with self._lock:
+            self.queries += 1
+            self.total_time += duration
+            count = self.statements.get(statement, 0) + 1
+            self.statements[statement] = count
+            repeated = count >= _settings['repeat_threshold'] and statement not in self.flagged
+            if repeated:
+                self.flagged.add(statement)
+        return count if repeated else 0
+
+
+# ===== Управление =====
+
+def enable(**settings):
+    """Включает инструментирование; можно передать slow_query_ms и repeat_threshold"""
+    _settings.update({key: value for key, value in settings.items() if key in _settings})
+    _settings['enabled'] = True
+
+
+def disable():
+    _settings['enabled'] = False
+
+
+def get_settings():
+    return dict(_settings)
+
+
+def attach(engine):
+    """Подписывается на события движка (один раз на движок)"""
+    if id(engine) in _attached:
+        return
+    _attached.add(id(engine))
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# ===== Единицы работы =====
+
+def begin(name):
+    """Начинает единицу работы в текущем контексте; вернуть токен в end()"""
+    return _current_unit.set(UnitOfWork(name))
+
+
+def end(token):
+    unit = _current_unit.get()
+    _current_unit.reset(token)
+    if unit is not None and unit.queries and _settings['enabled']:
+        level = logging.WARNING if unit.flagged else logging.DEBUG
+        logger.log(level, "%s: %s запросов, %.1f мс, повторяющихся SQL: %s",
+                   unit.name, unit.queries, unit.total_time * 1000, len(unit.flagged))
+    return unit
+
+
+class SQLUnitMiddleware(BaseMiddleware):
+    """Внешняя middleware на dp.update: единица работы = один апдейт"""
+
+    async def __call__(self, handler, event, data):
+        token = begin(f"update:{event.update_id}:{event.event_type}")
+        try:
+            return await handler(event, data)
+        finally:
+            end(token)
+
+
+# ===== События SQLAlchemy =====
+
+def _call_site():
+    """Первый кадр стека из кода проекта, не из SQLAlchemy и не из этого модуля"""
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename in _SKIP_FILES or not filename.startswith(_PROJECT_DIR):
+            continue
+        if os.sep + 'site-packages' + os.sep in filename:
+            continue
+        return f"{os.path.relpath(filename, _PROJECT_DIR)}:{frame.lineno} in {frame.name}"
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _settings['enabled']:
+        conn.info.setdefault('sql_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('sql_started')
+    if not started:
+        return
+    duration = time.perf_counter() - started.pop()
+    if not _settings['enabled']:
+        return
+
+    unit = _current_unit.get()
+    if unit is not None:
+        repeated = unit.record(statement, duration)
+        if repeated:
+            logger.warning("Возможный N+1 в %s: запрос выполнен %s раз (%s)\n%s",
+                           unit.name, repeated, _call_site(), statement)
+
+    if duration * 1000 >= _settings['slow_query_ms']:
+        slow_logger.warning(json.dumps({
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'duration_ms': round(duration * 1000, 2),
+            'unit': unit.name if unit is not None else None,
+            'call_site': _call_site(),
+            'statement': statement,
+            'parameters': repr(parameters)[:500],
+        }, ensure_ascii=False))
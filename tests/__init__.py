@@ -0,0 +1,11 @@
+"""Тесты: python -m unittest discover tests или python -m pytest tests.
+
+Окружение готовится здесь, до импорта модулей бота: config читает его при
+импорте, поэтому база одна на весь прогон.
+"""
+import os
+
+from benchmarks.common import prepare_env
+
+DB_PATH = prepare_env()
+os.environ.setdefault('SQLITE_BUSY_TIMEOUT_MS', '50')
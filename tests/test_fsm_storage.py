@@ -0,0 +1,70 @@
+"""Хранилище FSM: два экземпляра SQLiteStorage на одной базе — как два процесса бота.
+
+    python -m unittest tests.test_fsm_storage
+"""
+import unittest
+
+import tests  # noqa: F401  окружение до импорта модулей бота
+
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from bot_handlers import OrderForm
+from fsm_storage import SQLiteStorage, FSMWriteMiddleware
+
+database.init_db()
+
+
+class SQLiteStorageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.first = SQLiteStorage()
+        self.second = SQLiteStorage()
+
+    async def asyncTearDown(self):
+        await self.first.close()
+        await self.second.close()
+
+    async def test_processes_see_each_other_writes(self):
+        key = StorageKey(bot_id=42, chat_id=100, user_id=100)
+        self.assertIsNone(await self.second.get_state(key))
+
+        await self.first.set_state(key, OrderForm.bot_type)
+        await self.first.set_data(key, {'bot_type': 'Магазин'})
+        # Второй процесс уже закэшировал пустую запись и должен её перечитать
+        self.assertEqual(await self.second.get_state(key), OrderForm.bot_type.state)
+        self.assertEqual(await self.second.get_data(key), {'bot_type': 'Магазин'})
+
+        await self.second.set_data(key, {'bot_type': 'Магазин', 'functionality': 'Каталог'})
+        self.assertEqual(await self.first.get_data(key), {'bot_type': 'Магазин', 'functionality': 'Каталог'})
+        self.assertEqual(await self.first.get_state(key), OrderForm.bot_type.state)
+
+        await self.first.set_state(key, None)
+        await self.first.set_data(key, {})
+        self.assertIsNone(await self.second.get_state(key))
+        self.assertEqual(await self.second.get_data(key), {})
+
+    async def test_update_writes_once_at_the_end(self):
+        key = StorageKey(bot_id=42, chat_id=200, user_id=200)
+        writes = []
+        write = self.first.write
+
+        async def counting_write(pending):
+            writes.append(pending)
+            await write(pending)
+
+        self.first.write = counting_write
+
+        async def handler(event, data):
+            await self.first.set_state(key, OrderForm.functionality)
+            await self.first.set_data(key, {**await self.first.get_data(key), 'bot_type': 'Бот'})
+            self.assertEqual(await self.first.get_state(key), OrderForm.functionality.state)
+            self.assertEqual(writes, [])
+
+        await FSMWriteMiddleware(self.first)(handler, None, {})
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(await self.second.get_state(key), OrderForm.functionality.state)
+        self.assertEqual(await self.second.get_data(key), {'bot_type': 'Бот'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Статистика партнёров: partner_stats, правленная на месте, сходится с пересчётом.
+
+    python -m unittest tests.test_partner_stats
+"""
+import unittest
+
+import tests  # noqa: F401  окружение до импорта модулей бота
+
+import database
+from database import (Order, User, delete_order, get_or_create_user, get_partner_stats, submit_order,
+                      update_order_status, verify_partner_stats)
+from writer import GroupCommitWriter, _Write
+
+database.init_db()
+
+PARTNER, FIRST, SECOND = 501, 502, 503
+
+
+def _signup(session, telegram_id, referrer=None):
+    referral_code = None
+    if referrer is not None:
+        referral_code = str(session.query(User.id).filter_by(telegram_id=referrer).scalar())
+    return get_or_create_user(session, telegram_id, referral_code=referral_code).id
+
+
+def _order(session, telegram_id, budget):
+    order, user, partner = submit_order(session, telegram_id, None, None, None,
+                                        'Магазин', 'Каталог', 'Все', '', budget=budget)
+    return order.id
+
+
+def _set_paid(session, order_id, paid):
+    session.query(Order).filter_by(id=order_id).one().partner_paid = paid
+    session.commit()
+    return order_id
+
+
+def _complete_and_fail(session, order_id):
+    session.query(Order).filter_by(id=order_id).one().status = 'completed'
+    session.flush()
+    raise RuntimeError('операция упала')
+
+
+class PartnerStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = GroupCommitWriter()
+
+    def _run(self, *writes):
+        # Одна пачка писателя: каждая операция в своём SAVEPOINT, общий COMMIT
+        batch = [_Write(func, args, {}) for func, *args in writes]
+        self.writer._commit(batch)
+        with database.session_scope() as session:
+            self.assertEqual(verify_partner_stats(session), [])
+        return [write.future.result(timeout=1) if write.future.exception(timeout=1) is None else None
+                for write in batch]
+
+    def _stats(self, partner_id):
+        with database.session_scope() as session:
+            return get_partner_stats(session, partner_id)
+
+    def test_stats_follow_order_lifecycle(self):
+        partner_id, _, _ = self._run((_signup, PARTNER), (_signup, FIRST, PARTNER), (_signup, SECOND, PARTNER))
+        self.assertEqual(self._stats(partner_id)['total_referrals'], 2)
+
+        # Процент партнёра — только с первого заказа реферала
+        first, repeat, second = self._run((_order, FIRST, 100000), (_order, FIRST, 50000), (_order, SECOND, 200000))
+
+        # Упавшая операция откатывается вместе со своей поправкой статистики
+        self._run((update_order_status, first, 'completed'), (_complete_and_fail, second),
+                  (update_order_status, repeat, 'completed'))
+        stats = self._stats(partner_id)
+        self.assertEqual(stats['completed_orders'], 1)
+        self.assertGreater(stats['pending_payments'], 0)
+
+        self._run((update_order_status, second, 'completed'), (_set_paid, first, True))
+        stats = self._stats(partner_id)
+        self.assertEqual(stats['completed_orders'], 2)
+        self.assertGreater(stats['total_earnings'], 0)
+
+        self._run((_set_paid, first, False), (update_order_status, second, 'in_progress'))
+        self.assertEqual(self._stats(partner_id)['total_earnings'], 0)
+
+        self._run((delete_order, first), (delete_order, second), (delete_order, repeat))
+        stats = self._stats(partner_id)
+        self.assertEqual((stats['completed_orders'], stats['pending_payments'], stats['total_earnings']), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
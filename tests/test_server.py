@@ -0,0 +1,59 @@
+"""HTTP-сервер: WSGI-мост админки и вебхук.
+
+    python -m unittest tests.test_server
+"""
+import unittest
+
+import tests  # noqa: F401  окружение до импорта модулей бота
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+from flask import Flask, jsonify, request
+
+import database
+from server import create_app
+from update_queue import UpdateQueue
+
+database.init_db()
+
+admin_app = Flask(__name__)
+
+
+@admin_app.route('/echo')
+def echo():
+    return jsonify({'args': request.args.to_dict(flat=False), 'query': request.query_string.decode('ascii')})
+
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = Bot('42:TEST')
+        self.update_queue = UpdateQueue(Dispatcher(), self.bot)
+        self.client = TestClient(TestServer(create_app(self.bot, self.update_queue, admin_app=admin_app)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.bot.session.close()
+
+    async def test_admin_gets_raw_query_string(self):
+        query = 'q=%D0%B1%D0%BE%D1%82&tag=a%26b&text=1+2'
+        response = await self.client.get(f'/echo?{query}')
+        self.assertEqual(response.status, 200)
+        data = await response.json()
+        self.assertEqual(data['query'], query)
+        self.assertEqual(data['args'], {'q': ['бот'], 'tag': ['a&b'], 'text': ['1 2']})
+
+    async def test_webhook_rejects_malformed_body(self):
+        for body in (b'not json', b'[1, 2]', b'{"update_id": "x"}'):
+            response = await self.client.post('/webhook', data=body, headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status, 400, body)
+        self.assertEqual(self.update_queue.stats()['depth'], 0)
+
+    async def test_webhook_accepts_update(self):
+        response = await self.client.post('/webhook', json={'update_id': 1})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.update_queue.stats()['depth'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Поток-писатель: ошибки вне операций пачки и уведомления слушателей.
+
+    python -m unittest tests.test_writer
+"""
+import sqlite3
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from tests import DB_PATH
+import database
+from database import User, add_commit_listener
+from writer import GroupCommitWriter, _Write
+
+database.init_db()
+
+
+def _add_user(session, telegram_id):
+    session.add(User(telegram_id=telegram_id))
+    session.commit()
+    return telegram_id
+
+
+def _fail(session):
+    session.add(User(telegram_id=-1))
+    session.flush()
+    raise RuntimeError('операция упала')
+
+
+class GroupCommitWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = GroupCommitWriter()
+        self.notified = []
+        add_commit_listener(self._on_commit)
+
+    def tearDown(self):
+        database._commit_listeners.remove(self._on_commit)
+
+    def _on_commit(self, changes):
+        # Слушатель видит изменения уже записанными: другое соединение их читает
+        with sqlite3.connect(DB_PATH) as connection:
+            committed = {row[0] for row in connection.execute('SELECT telegram_id FROM users')}
+        self.notified.append([(obj.telegram_id, op, obj.telegram_id in committed)
+                              for obj, op in changes if isinstance(obj, User)])
+
+    def test_locked_database_fails_every_future(self):
+        batch = [_Write(_add_user, (telegram_id,), {}) for telegram_id in (101, 102)]
+        locker = sqlite3.connect(DB_PATH, isolation_level=None)
+        locker.execute('BEGIN IMMEDIATE')
+        try:
+            self.writer._commit(batch)
+        finally:
+            locker.rollback()
+            locker.close()
+        for write in batch:
+            self.assertIsInstance(write.future.exception(timeout=1), OperationalError)
+        self.assertEqual(self.writer.failed, 2)
+        self.assertEqual(self.notified, [])
+
+    def test_listeners_get_only_committed_writes_after_commit(self):
+        batch = [_Write(_add_user, (201,), {}), _Write(_fail, (), {}), _Write(_add_user, (202,), {})]
+        self.writer._commit(batch)
+        self.assertEqual([write.future.result(timeout=1) for write in (batch[0], batch[2])], [201, 202])
+        self.assertIsInstance(batch[1].future.exception(timeout=1), RuntimeError)
+        self.assertEqual(self.notified, [[(201, 'insert', True), (202, 'insert', True)]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Ограничение частоты апдейтов от одного пользователя.
+
+Внутренняя middleware на message и callback_query: на каждую пару
+(пользователь, хендлер) — свой token bucket. Одинаковый запрос (тот же
+текст или callback data), пришедший, пока предыдущий ещё обрабатывается или
+сразу после него, отбрасывается. Апдейты сверх лимита до хендлера не доходят:
+если у хендлера включён cache_ttl, пользователь получает повтор последнего
+ответа на такой же запрос (без обращения к базе), иначе апдейт молча
+отбрасывается; нажатие кнопки при этом всё равно подтверждается.
+
+Настройки хендлера задаются флагом при регистрации:
+
+    dp.message.register(show_my_orders, F.text == "📋 Мои заказы",
+                        flags={'throttling': {'rate': 0.2, 'burst': 2, 'cache_ttl': 10}})
+
+flags={'throttling': False} отключает ограничение для хендлера.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.flags import get_flag
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+import metrics
+from config import THROTTLE_RATE, THROTTLE_BURST, THROTTLE_COALESCE_WINDOW
+from outbound import TokenBucket, answer, capture_replies
+
+logger = logging.getLogger(__name__)
+
+MAX_KEYS = 10000
+
+THROTTLED = metrics.registry.counter(
+    'bot_throttled_updates_total', 'Апдейты, не дошедшие до хендлера из-за ограничения частоты',
+    ('handler', 'action'))
+
+
+def _store(cache, key, value, limit=MAX_KEYS):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST, window=THROTTLE_COALESCE_WINDOW, cache_ttl=0):
+        self.defaults = {'rate': rate, 'burst': burst, 'window': window, 'cache_ttl': cache_ttl}
+        self._buckets = OrderedDict()  # (user_id, handler) -> TokenBucket
+        self._finished = OrderedDict()  # (user_id, handler, payload) -> когда закончилась обработка
+        self._replies = OrderedDict()  # (user_id, handler, payload) -> (время, [(text, kwargs)])
+        self._in_flight = set()
+
+    async def __call__(self, handler, event, data):
+        flag = get_flag(data, 'throttling')
+        user = data.get('event_from_user')
+        if flag is False or user is None:
+            return await handler(event, data)
+
+        settings = {**self.defaults, **(flag or {})}
+        name = getattr(getattr(data.get('handler'), 'callback', None), '__name__', 'unknown')
+        payload = event.text if isinstance(event, Message) else getattr(event, 'data', None)
+        key = (user.id, name)
+        request_key = key + (payload,)
+
+        now = time.monotonic()
+        if request_key in self._in_flight or now - self._finished.get(request_key, float('-inf')) < settings['window']:
+            return await self._reject(event, name, 'coalesced')
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(settings['rate'], settings['burst'])
+            _store(self._buckets, key, bucket)
+        else:
+            self._buckets.move_to_end(key)
+        if not bucket.try_acquire():
+            cached = self._replies.get(request_key)
+            if cached is not None and now - cached[0] < settings['cache_ttl']:
+                return await self._reject(event, name, 'cached', cached[1])
+            return await self._reject(event, name, 'dropped')
+
+        self._in_flight.add(request_key)
+        try:
+            if settings['cache_ttl'] and isinstance(event, Message):
+                with capture_replies() as replies:
+                    result = await handler(event, data)
+                _store(self._replies, request_key, (time.monotonic(), replies))
+                return result
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(request_key)
+            _store(self._finished, request_key, time.monotonic())
+
+    async def _reject(self, event, name, action, replies=None):
+        THROTTLED.inc(handler=name, action=action)
+        if replies:
+            for text, kwargs in replies:
+                await answer(event, text, **kwargs)
+        elif isinstance(event, CallbackQuery):
+            # Иначе у пользователя будет крутиться индикатор загрузки на кнопке
+            await event.answer()
+
+
+def setup_throttling(dp: Dispatcher):
+    """Подключать до остальных внутренних middleware: отброшенные апдейты не попадают в их метрики"""
+    middleware = ThrottlingMiddleware()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
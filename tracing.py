@@ -0,0 +1,233 @@
+"""Лёгкая трассировка апдейтов.
+
+На каждый апдейт — корневой span (update_id, чат, хендлер, состояние FSM),
+внутри — дочерние span'ы для каждого SQL-запроса и каждого вызова Bot API.
+Решение о записи принимается один раз на апдейт (TRACE_SAMPLE_RATE): для
+невыбранных апдейтов span'ы не создаются вовсе, и все хуки сразу выходят.
+Готовые span'ы пишутся в TRACE_FILE построчно в JSON отдельным потоком,
+так что event loop на запись в файл не тратится.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from sqlalchemy import event
+
+from config import TRACE_SAMPLE_RATE, TRACE_FILE
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('trace_span', default=None)
+_attached = set()
+
+
+class JsonlExporter:
+    """Пишет span'ы в файл в фоновом потоке, пачками"""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+        self._queue.put(record)
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as file:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < 500:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    file.write(''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n'
+                                       for record in batch))
+                    file.flush()
+                except Exception:
+                    logger.exception("Не удалось записать трассировку в %s", self.path)
+
+
+exporter = JsonlExporter(TRACE_FILE)
+_sample_rate = TRACE_SAMPLE_RATE
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start', 'status')
+
+    def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.status = 'ok'
+
+    def child(self, name, **attributes):
+        return Span(name, self.trace_id, self.span_id, attributes)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error=None):
+        end = time.time()
+        if error is not None:
+            self.status = 'error'
+            self.attributes['error'] = repr(error)[:300]
+        exporter.export({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_id,
+            'name': self.name,
+            'start_time': self.start,
+            'end_time': end,
+            'duration_ms': round((end - self.start) * 1000, 3),
+            'status': self.status,
+            'attributes': self.attributes,
+        })
+
+
+# ===== API =====
+
+def set_sample_rate(rate):
+    global _sample_rate
+    _sample_rate = rate
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def use_span(span):
+    """Делает span текущим (например, в задаче воркера, отправляющей сообщение апдейта)"""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """Корневой span; None, если трасса не попала в выборку"""
+    if not _sample_rate or random.random() >= _sample_rate:
+        yield None
+        return
+    span = Span(name, attributes=attributes)
+    with _finishing(span):
+        yield span
+
+
+@contextmanager
+def start_span(name, **attributes):
+    """Дочерний span текущего; None вне трассы"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _finishing(parent.child(name, **attributes)) as span:
+        yield span
+
+
+@contextmanager
+def _finishing(span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        _current_span.reset(token)
+        span.finish(error=e)
+        raise
+    _current_span.reset(token)
+    span.finish()
+
+
+# ===== Интеграции =====
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Внешняя middleware на dp.update: корневой span апдейта"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        with start_trace('update', update_id=event.update_id, event_type=event.event_type,
+                         chat_id=chat.id if chat else None, user_id=user.id if user else None):
+            return await handler(event, data)
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """Внутренняя middleware: дописывает в корневой span выбранный хендлер и состояние FSM"""
+
+    async def __call__(self, handler, event, data):
+        span = _current_span.get()
+        if span is not None:
+            handler_object = data.get('handler')
+            span.set(handler=getattr(getattr(handler_object, 'callback', None), '__name__', None),
+                     state=data.get('raw_state'))
+        return await handler(event, data)
+
+
+class BotAPITracingMiddleware(BaseRequestMiddleware):
+    """Span на каждый запрос к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        if _current_span.get() is None:
+            return await make_request(bot, method)
+        with start_span(f'bot_api.{type(method).__name__}', chat_id=getattr(method, 'chat_id', None)):
+            return await make_request(bot, method)
+
+
+def setup_tracing(dp, bot):
+    dp.update.outer_middleware(UpdateTracingMiddleware())
+    handler_middleware = HandlerTracingMiddleware()
+    dp.message.middleware(handler_middleware)
+    dp.callback_query.middleware(handler_middleware)
+    bot.session.middleware(BotAPITracingMiddleware())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current_span.get()
+    stack = conn.info.setdefault('trace_spans', [])
+    stack.append(parent.child('db.query', statement=statement[:300]) if parent is not None else None)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('trace_spans')
+    span = stack.pop() if stack else None
+    if span is not None:
+        span.finish()
+
+
+def _handle_error(context):
+    connection = context.connection
+    stack = connection.info.get('trace_spans') if connection is not None else None
+    span = stack.pop() if stack else None
+    if span is not None:
+        span.finish(error=context.original_exception)
+
+
+def attach(engine):
+    """Span'ы для SQL-запросов движка (один раз на движок)"""
+    if id(engine) in _attached:
+        return
+    _attached.add(id(engine))
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
@@ -0,0 +1,125 @@
+"""Очередь входящих апдейтов с пулом воркеров.
+
+Апдейты одного чата обрабатываются строго по очереди (иначе ломается FSM
+OrderForm, когда пользователь быстро печатает), разных чатов — параллельно.
+Очередь ограничена: при переполнении submit() возвращает False, и вызывающий
+код применяет UPDATE_OVERLOAD_POLICY.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import UPDATE_WORKERS, UPDATE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def get_chat_key(update: Update):
+    """Ключ упорядочивания: id чата, иначе id пользователя, иначе сам update_id"""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    def __init__(self, dp: Dispatcher, bot: Bot, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.maxsize = maxsize
+
+        self._pending = {}  # chat_key -> deque[(update, enqueued_at)]
+        self._ready = asyncio.Queue()  # чаты с апдейтами, которые сейчас никто не обрабатывает
+        self._active = set()  # чаты в обработке
+        self._size = 0
+        self._tasks = []
+
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+
+    def submit(self, update: Update):
+        """Ставит апдейт в очередь. False — очередь переполнена, апдейт не принят"""
+        if self._size >= self.maxsize:
+            self.rejected += 1
+            return False
+
+        key = get_chat_key(update)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+        pending.append((update, time.monotonic()))
+        self._size += 1
+
+        # Чат попадает в _ready только если он не в работе и не стоит там уже
+        if key not in self._active and len(pending) == 1:
+            self._ready.put_nowait(key)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            self._active.add(key)
+            pending = self._pending[key]
+            update, enqueued_at = pending.popleft()
+            self._size -= 1
+            self.last_lag = time.monotonic() - enqueued_at
+
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Ошибка обработки апдейта %s", update.update_id)
+            finally:
+                self._active.discard(key)
+                # Следующий апдейт чата — в конец очереди, чтобы не держать воркер за одним чатом
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain=True, timeout=30):
+        """Останавливает воркеров, по умолчанию дождавшись обработки очереди"""
+        if drain:
+            deadline = time.monotonic() + timeout
+            while (self._size or self._active) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        now = time.monotonic()
+        oldest = min((pending[0][1] for pending in self._pending.values() if pending), default=now)
+        return {
+            'depth': self._size,
+            'maxsize': self.maxsize,
+            'chats': len(self._pending),
+            'in_progress': len(self._active),
+            'workers': self.workers,
+            'lag': round(now - oldest, 3),
+            'last_lag': round(self.last_lag, 3),
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,79 @@
+"""Кэш пользователей по telegram_id.
+
+Почти каждый хендлер начинает с поиска пользователя по telegram_id; кэш
+превращает этот запрос в поиск по словарю. Хранятся компактные неизменяемые
+записи CachedUser, а не ORM-объекты: их безопасно отдавать в любые потоки.
+Изменения, прошедшие через ORM, обновляют кэш после commit (см.
+add_commit_listener); правки в обход ORM подхватятся по истечении TTL.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from database import User, add_commit_listener
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+
+CachedUser = namedtuple('CachedUser', 'id telegram_id username first_name last_name referral_id is_partner')
+
+
+def to_cached(user):
+    return CachedUser(user.id, user.telegram_id, user.username, user.first_name, user.last_name,
+                      user.referral_id, bool(user.is_partner))
+
+
+class UserCache:
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # telegram_id -> (expires, CachedUser)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id):
+        with self._lock:
+            item = self._items.get(telegram_id)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[telegram_id]
+                self.misses += 1
+                return None
+            self._items.move_to_end(telegram_id)
+            self.hits += 1
+            return item[1]
+
+    def put(self, user):
+        """Кладёт пользователя (ORM-объект или CachedUser) в кэш и возвращает CachedUser"""
+        record = user if isinstance(user, CachedUser) else to_cached(user)
+        with self._lock:
+            self._items[record.telegram_id] = (time.monotonic() + self.ttl, record)
+            self._items.move_to_end(record.telegram_id)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return record
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._items.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'size': len(self._items), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+cache = UserCache()
+
+
+@add_commit_listener
+def _update_user_cache(changes):
+    for obj, op in changes:
+        if not isinstance(obj, User):
+            continue
+        if op == 'insert':
+            cache.put(obj)
+        else:
+            # Порядок commit'ов разных потоков не гарантирован — надёжнее перечитать из базы
+            cache.invalidate(obj.telegram_id)
@@ -1,86 +1,93 @@
-from flask import Flask, render_template, jsonify, request
-from sqlalchemy.orm import sessionmaker
-from database import init_db, User, Order
-from config import CURRENCY
-from datetime import datetime
+import csv
+import io
+import json
+from flask import Flask, Response, render_template, jsonify, request, g, stream_with_context
+from markupsafe import escape
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import aliased
+import database
+from database import init_db, get_session, User, Order, PartnerStats
+import dashboard
+import sql_instrumentation
+from writer import writer
+from config import CURRENCY, ORDERS_PAGE_SIZE, BULK_MAX_ORDERS, PARTNER_FILTER_LIMIT
+from datetime import datetime, timedelta
+
+ORDER_STATUSES = ('new', 'in_progress', 'completed', 'archived')
+EXPORT_BATCH_SIZE = 1000  # строк из базы за раз
+EXPORT_CHUNK_SIZE = 64 * 1024  # байт в одном куске ответа
 
 app = Flask(__name__)
 app.secret_key = 'telegram-bot-admin-panel-secret-key'
 
-# Инициализация базы
+# Инициализация базы (движок и пул общие с ботом)
 engine = init_db()
-Session = sessionmaker(bind=engine)
 
 
 def get_db_session():
-    return Session()
+    return get_session()
 
 
-@app.route('/')
-def admin_dashboard():
-    session = get_db_session()
-    try:
-        # Статистика
-        total_orders = session.query(Order).count()
-        new_orders = session.query(Order).filter_by(status='new').count()
-        total_partners = session.query(User).filter_by(is_partner=True).count()
+@app.before_request
+def start_sql_unit():
+    g.sql_unit = sql_instrumentation.begin(f"{request.method} {request.path}")
 
-        # ВРЕМЕННО УБРАЛИ ВЫПЛАТЫ
-        pending_sum = 0  # Временное значение
 
-        # Последние заказы (5 штук)
-        orders = session.query(Order).order_by(Order.created_at.desc()).limit(5).all()
+@app.teardown_request
+def end_sql_unit(exc):
+    token = g.pop('sql_unit', None)
+    if token is not None:
+        sql_instrumentation.end(token)
 
-        # Собираем данные для заказов
-        order_list = []
-        for order in orders:
-            user = session.query(User).filter_by(id=order.user_id).first()
-            partner = session.query(User).filter_by(id=order.partner_id).first() if order.partner_id else None
 
-            order_list.append({
-                'id': order.id,
-                'user': {
-                    'name': f"{user.first_name} {user.last_name or ''}",
-                    'username': user.username
-                } if user else {'name': 'Неизвестно', 'username': ''},
-                'bot_type': order.bot_type,
-                'status': order.status,
-                'amount': order.amount,
-                'created_at': order.created_at,
-                'partner': {
-                    'name': f"{partner.first_name} {partner.last_name or ''}",
-                    'username': partner.username
-                } if partner else None
-            })
+Client = aliased(User, name='client')
+Partner = aliased(User, name='partner')
 
-        # Партнёры
-        partners = session.query(User).filter_by(is_partner=True).all()
-        partner_stats = []
-        for partner in partners:
-            referrals = session.query(User).filter_by(referral_id=partner.id).count()
-            
-            # ВРЕМЕННО УБРАЛИ ВЫПЛАТЫ
-            pending = 0
-            earned = 0
-
-            partner_stats.append({
-                'id': partner.id,
-                'name': f"{partner.first_name} {partner.last_name or ''}",
-                'username': partner.username,
-                'referrals': referrals,
-                'pending_payments': pending,
-                'total_earnings': earned
-            })
 
+def query_orders_with_users(session):
+    """Заказы вместе с клиентом и партнёром одним запросом (без N+1)"""
+    return session.query(Order, Client, Partner) \
+        .outerjoin(Client, Client.id == Order.user_id) \
+        .outerjoin(Partner, Partner.id == Order.partner_id)
+
+
+def encode_cursor(order):
+    return f"{order.created_at.isoformat()}_{order.id}"
+
+
+def decode_cursor(cursor):
+    """Курсор keyset-пагинации: (created_at, id) последнего заказа на странице"""
+    try:
+        created_at, order_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def order_criteria(status='all', partner_id='all'):
+    """Условия фильтра заказов, общие для списка и массовых операций"""
+    criteria = []
+    if status != 'all':
+        criteria.append(Order.status == status)
+    if partner_id != 'all':
+        criteria.append(Order.partner_id == partner_id)
+    return criteria
+
+
+@app.route('/')
+def admin_dashboard():
+    session = get_db_session()
+    try:
+        # Агрегаты и последние заказы — из кэша, пересчитываются только устаревшие разделы
+        values = dashboard.cache.get(session)
         return render_template('admin.html',
                                stats={
-                                   'total_orders': total_orders,
-                                   'new_orders': new_orders,
-                                   'total_partners': total_partners,
-                                   'pending_payments': pending_sum
+                                   'total_orders': values['total_orders'],
+                                   'new_orders': values['new_orders'],
+                                   'total_partners': values['total_partners'],
+                                   'pending_payments': values['pending_payments']
                                },
-                               orders=order_list,
-                               partners=partner_stats,
+                               orders=values['orders'],
                                currency=CURRENCY)
     except Exception as e:
         print(f"Ошибка в админ-панели: {e}")
@@ -95,39 +102,44 @@ def orders_page():
     try:
         status = request.args.get('status', 'all')
         partner_id = request.args.get('partner', 'all')
+        cursor = decode_cursor(request.args.get('after'))
 
-        # Базовый запрос
-        query = session.query(Order)
-
-        # Фильтры
-        if status != 'all':
-            query = query.filter_by(status=status)
+        # Базовый запрос с фильтрами
+        query = query_orders_with_users(session).filter(*order_criteria(status, partner_id))
 
-        if partner_id != 'all':
-            query = query.filter_by(partner_id=partner_id)
+        # Keyset-пагинация: стоимость страницы не зависит от размера таблицы
+        if cursor:
+            created_at, order_id = cursor
+            query = query.filter(or_(Order.created_at < created_at,
+                                     and_(Order.created_at == created_at, Order.id < order_id)))
 
-        orders = query.order_by(Order.created_at.desc()).all()
+        rows = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(ORDERS_PAGE_SIZE + 1).all()
+        next_cursor = encode_cursor(rows[ORDERS_PAGE_SIZE - 1][0]) if len(rows) > ORDERS_PAGE_SIZE else None
 
         # Собираем данные
         order_list = []
-        for order in orders:
-            user = session.query(User).filter_by(id=order.user_id).first()
-            partner = session.query(User).filter_by(id=order.partner_id).first() if order.partner_id else None
-
+        for order, user, partner in rows[:ORDERS_PAGE_SIZE]:
             order_list.append({
                 'order': order,
                 'user': user,
                 'partner': partner
             })
 
-        # Партнёры для фильтра
-        partners = session.query(User).filter_by(is_partner=True).all()
+        # Партнёры для фильтра: только с заказами, самые активные, плюс выбранный
+        partners = session.query(User.id, User.username, User.first_name) \
+            .join(PartnerStats, PartnerStats.partner_id == User.id) \
+            .filter(PartnerStats.total_orders > 0) \
+            .order_by(PartnerStats.total_orders.desc()).limit(PARTNER_FILTER_LIMIT).all()
+        if partner_id.isdigit() and all(partner.id != int(partner_id) for partner in partners):
+            partners += session.query(User.id, User.username, User.first_name).filter(User.id == int(partner_id)).all()
 
         return render_template('orders.html',
                                orders=order_list,
                                partners=partners,
                                current_status=status,
                                current_partner=partner_id,
+                               next_cursor=next_cursor,
+                               is_first_page=cursor is None,
                                currency=CURRENCY)
     finally:
         session.close()
@@ -135,19 +147,16 @@ def orders_page():
 
 @app.route('/api/update_order_status/<int:order_id>', methods=['POST'])
 def update_order_status(order_id):
-    session = get_db_session()
+    status = (request.json or {}).get('status')
+    if not status:
+        return jsonify({'success': False, 'error': 'Не указан статус'}), 400
     try:
-        data = request.json
-        order = session.query(Order).filter_by(id=order_id).first()
-        if order:
-            order.status = data.get('status', order.status)
-            session.commit()
+        # Запись — через общий поток-писатель, вместе с записями бота
+        if writer.call(database.update_order_status, order_id, status):
             return jsonify({'success': True})
         return jsonify({'success': False}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        session.close()
 
 
 # ВРЕМЕННО УБРАЛИ ФУНКЦИЮ ВЫПЛАТ
@@ -156,22 +165,231 @@ def update_order_status(order_id):
 #     ... код удален ...
 
 
+@app.route('/api/debug/sql', methods=['GET', 'POST'])
+def debug_sql():
+    """Включение/выключение инструментирования SQL без рестарта"""
+    if request.method == 'POST':
+        data = request.json or {}
+        if data.get('enabled'):
+            sql_instrumentation.enable(**{key: data[key] for key in ('slow_query_ms', 'repeat_threshold')
+                                          if key in data})
+        else:
+            sql_instrumentation.disable()
+    return jsonify(sql_instrumentation.get_settings())
+
+
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'ok', 'message': 'Admin panel is running'})
 
 @app.route('/api/delete_order/<int:order_id>', methods=['DELETE'])
 def delete_order(order_id):
-    session = get_db_session()
     try:
-        order = session.query(Order).filter_by(id=order_id).first()
-        if order:
-            session.delete(order)
-            session.commit()
+        if writer.call(database.delete_order, order_id):
             return jsonify({'success': True, 'message': f'Заказ #{order_id} удален'})
         return jsonify({'success': False, 'message': 'Заказ не найден'}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+
+
+# ===== Массовые операции =====
+# Заказы выбираются списком ids или фильтром как у /orders:
+#   {"ids": [1, 2, 3]} или {"filter": {"status": "new", "partner": 5}}
+# Каждая операция — одна транзакция в потоке-писателе.
+
+def bulk_criteria(data):
+    """Условия отбора для массовой операции; None — не задано ни ids, ни фильтра.
+
+    ValueError — тело запроса не объект или ids/filter неверного вида.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Ожидается JSON-объект')
+    ids = data.get('ids')
+    if ids is not None:
+        # bool — подкласс int, но id заказа им быть не может
+        if not isinstance(ids, list) or not all(type(order_id) is int for order_id in ids):
+            raise ValueError('ids — список целых чисел')
+        if ids:
+            return [Order.id.in_(ids)]
+    filters = data.get('filter') or {}
+    if not isinstance(filters, dict):
+        raise ValueError('filter — объект')
+    # Пустой фильтр выбрал бы все заказы — такое только явным списком
+    return order_criteria(str(filters.get('status', 'all')), str(filters.get('partner', 'all'))) or None
+
+
+def _bulk_status(data, status):
+    criteria = bulk_criteria(data)
+    if criteria is None:
+        return jsonify({'success': False, 'error': 'Не заданы заказы'}), 400
+    updated = writer.call(database.bulk_update_order_status, criteria, status, BULK_MAX_ORDERS)
+    if updated is None:
+        return jsonify({'success': False, 'error': f'Больше {BULK_MAX_ORDERS} заказов, сузьте фильтр'}), 400
+    return jsonify({'success': True, 'status': status, 'updated': updated})
+
+
+@app.route('/api/orders/bulk_status', methods=['POST'])
+def bulk_update_status():
+    data = request.get_json(silent=True)
+    try:
+        status = data.get('status') if isinstance(data, dict) else None
+        if status not in ORDER_STATUSES:
+            return jsonify({'success': False, 'error': 'Неизвестный статус'}), 400
+        return _bulk_status(data, status)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/orders/bulk_archive', methods=['POST'])
+def bulk_archive():
+    try:
+        return _bulk_status(request.get_json(silent=True), 'archived')
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/orders/bulk_delete', methods=['POST'])
+def bulk_delete():
+    try:
+        criteria = bulk_criteria(request.get_json(silent=True))
+        if criteria is None:
+            return jsonify({'success': False, 'error': 'Не заданы заказы'}), 400
+        deleted = writer.call(database.bulk_delete_orders, criteria, BULK_MAX_ORDERS)
+        if deleted is None:
+            return jsonify({'success': False, 'error': f'Больше {BULK_MAX_ORDERS} заказов, сузьте фильтр'}), 400
+        return jsonify({'success': True, 'deleted': deleted})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+# ===== Поиск =====
+
+def render_snippet(snippet):
+    """Экранирует фрагмент текста заказа и подсвечивает найденные слова"""
+    return str(escape(snippet or '')) \
+        .replace(database.SNIPPET_START, '<mark>').replace(database.SNIPPET_END, '</mark>')
+
+
+@app.route('/api/orders/search')
+def search_orders():
+    """Поиск по текстам анкеты: q — слова, page — страница с нуля, status — необязательный фильтр"""
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 0, type=int), 0)
+    status = request.args.get('status')
+    session = get_db_session()
+    try:
+        rows, total = database.search_orders(session, query, page, ORDERS_PAGE_SIZE,
+                                             status if status in ORDER_STATUSES else None)
+        return jsonify({
+            'success': True,
+            'query': query,
+            'total': total,
+            'page': page,
+            'pages': (total + ORDERS_PAGE_SIZE - 1) // ORDERS_PAGE_SIZE,
+            'results': [{
+                'id': row.id,
+                'status': row.status,
+                'bot_type': row.bot_type,
+                'amount': row.amount,
+                'created_at': row.created_at.strftime('%d.%m.%Y %H:%M') if row.created_at else None,
+                'client': f"{row.first_name or ''} {row.last_name or ''}".strip() or 'Неизвестно',
+                'username': row.username,
+                'snippet': render_snippet(row.snippet),
+            } for row in rows],
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         session.close()
 
+# ===== Выгрузка =====
+
+EXPORT_COLUMNS = ['id', 'created_at', 'status', 'bot_type', 'amount', 'partner_percent', 'partner_commission',
+                  'partner_paid', 'client_id', 'client_telegram_id', 'client_username', 'client_name',
+                  'partner_id', 'partner_username', 'partner_name']
+
+
+def query_orders_export(session, criteria):
+    """Строки выгрузки (только нужные колонки, без ORM-объектов) в порядке создания"""
+    return session.query(Order.id, Order.created_at, Order.status, Order.bot_type, Order.amount,
+                         Order.partner_percent, Order.partner_paid,
+                         Client.id, Client.telegram_id, Client.username, Client.first_name, Client.last_name,
+                         Partner.id, Partner.username, Partner.first_name, Partner.last_name) \
+        .outerjoin(Client, Client.id == Order.user_id) \
+        .outerjoin(Partner, Partner.id == Order.partner_id) \
+        .filter(*criteria) \
+        .order_by(Order.created_at, Order.id) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_record(row):
+    (order_id, created_at, status, bot_type, amount, percent, paid, client_id, client_telegram_id,
+     client_username, client_first, client_last, partner_id, partner_username, partner_first, partner_last) = row
+    return [order_id, created_at.isoformat(sep=' ', timespec='seconds') if created_at else None, status, bot_type,
+            amount, percent if partner_id else 0, round(amount * percent / 100, 2) if partner_id and amount else 0,
+            bool(paid), client_id, client_telegram_id, client_username,
+            f"{client_first or ''} {client_last or ''}".strip() or None,
+            partner_id, partner_username, f"{partner_first or ''} {partner_last or ''}".strip() or None]
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+@app.route('/api/orders/export')
+def export_orders():
+    """Потоковая выгрузка заказов в CSV или JSONL; память не зависит от числа строк.
+
+    Параметры: format=csv|jsonl, status и partner как у /orders,
+    date_from и date_to (ГГГГ-ММ-ДД, включительно).
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'success': False, 'error': 'Формат: csv или jsonl'}), 400
+    try:
+        date_from = _parse_date(request.args.get('date_from'))
+        date_to = _parse_date(request.args.get('date_to'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Дата в формате ГГГГ-ММ-ДД'}), 400
+
+    criteria = order_criteria(request.args.get('status', 'all'), request.args.get('partner', 'all'))
+    if date_from:
+        criteria.append(Order.created_at >= date_from)
+    if date_to:
+        criteria.append(Order.created_at < date_to + timedelta(days=1))
+
+    def generate():
+        session = get_db_session()
+        try:
+            buffer = io.StringIO()
+            if export_format == 'csv':
+                # BOM — чтобы Excel открыл кириллицу без вопросов о кодировке
+                buffer.write('\ufeff')
+                csv_writer = csv.writer(buffer)
+                csv_writer.writerow(EXPORT_COLUMNS)
+            for row in query_orders_export(session, criteria):
+                record = export_record(row)
+                if export_format == 'csv':
+                    csv_writer.writerow(record)
+                else:
+                    buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, record)), ensure_ascii=False))
+                    buffer.write('\n')
+                if buffer.tell() >= EXPORT_CHUNK_SIZE:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue().encode('utf-8')
+        finally:
+            session.close()
+
+    filename = f"orders-{datetime.now():%Y%m%d-%H%M}.{export_format}"
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
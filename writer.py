@@ -0,0 +1,151 @@
+"""Групповой commit: все записи в базу через один поток-писатель.
+
+SQLite допускает одного писателя, поэтому независимые commit'ы из потоков
+бота и админки под нагрузкой упираются в блокировку файла. Здесь операции
+записи — функции func(session, *args), как и для run_db — ставятся в общую
+очередь; поток-писатель забирает их пачкой (ждёт попутчиков не дольше
+WRITE_MAX_LATENCY_MS, но не больше WRITE_MAX_BATCH операций), выполняет в одной
+транзакции и делает один commit. Каждая операция выполняется в своём
+SAVEPOINT: ошибка одной не откатывает остальные. commit() внутри функций
+записи в пачке превращается во flush (см. database._Session).
+
+Результат возвращается через future: await writer.run(...) из event loop,
+writer.call(...) из потоков Flask.
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import text
+
+import database
+from config import WRITE_MAX_LATENCY_MS, WRITE_MAX_BATCH
+
+logger = logging.getLogger(__name__)
+
+
+class _Write:
+    __slots__ = ('func', 'args', 'kwargs', 'future', 'context')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        # Контекст вызывающего (единица работы SQL, трассировка) переносится в писателя
+        self.context = contextvars.copy_context()
+
+
+class GroupCommitWriter:
+    def __init__(self, max_latency=WRITE_MAX_LATENCY_MS / 1000, max_batch=WRITE_MAX_BATCH):
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+
+    # ===== Публичный API =====
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит func(session, *args, **kwargs) в очередь записи, возвращает concurrent.futures.Future"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                    self._thread.start()
+        write = _Write(func, args, kwargs)
+        self._queue.put(write)
+        return write.future
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def call(self, func, *args, **kwargs):
+        """Блокирующий вариант для синхронного кода (админка)"""
+        return self.submit(func, *args, **kwargs).result()
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'batches': self.batches, 'writes': self.writes,
+                'failed': self.failed}
+
+    # ===== Поток-писатель =====
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        session = database.Session()
+        session.info['group_commit'] = True
+        changes = session.info.setdefault('changes', [])
+        done = []
+        try:
+            if session.bind.dialect.name == 'sqlite':
+                # Блокировка записи берётся сразу, а не при первом INSERT посреди пачки
+                session.execute(text('BEGIN IMMEDIATE'))
+            for write in batch:
+                if not write.future.set_running_or_notify_cancel():
+                    continue
+                if len(batch) == 1:
+                    # Одиночной операции SAVEPOINT не нужен: её ошибка откатывает всю транзакцию
+                    try:
+                        done.append((write.future, write.context.run(write.func, session, *write.args,
+                                                                     **write.kwargs)))
+                    except Exception as e:
+                        session.rollback()
+                        self.failed += 1
+                        write.future.set_exception(e)
+                        return
+                    continue
+                mark = len(changes)
+                savepoint = session.begin_nested()
+                try:
+                    result = write.context.run(write.func, session, *write.args, **write.kwargs)
+                    session.flush()
+                    savepoint.commit()
+                except Exception as e:
+                    savepoint.rollback()
+                    # Откаченные изменения не должны попасть к слушателям add_commit_listener
+                    del changes[mark:]
+                    self.failed += 1
+                    write.future.set_exception(e)
+                else:
+                    done.append((write.future, result))
+            session.info['group_commit'] = False
+            session.commit()
+        except Exception as e:
+            # BEGIN (database is locked после busy_timeout), SAVEPOINT или COMMIT:
+            # ни одна операция пачки не записана, незавершённые future получают ошибку
+            logger.exception("Не удалось записать пачку из %s операций", len(batch))
+            for write in batch:
+                if not write.future.done():
+                    self.failed += 1
+                    write.future.set_exception(e)
+            session.rollback()
+        else:
+            self.batches += 1
+            self.writes += len(done)
+            for future, result in done:
+                future.set_result(result)
+        finally:
+            session.close()
+
+
+writer = GroupCommitWriter()